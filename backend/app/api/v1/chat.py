@@ -1,10 +1,12 @@
 from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
 from typing import List, Dict, Any
 import json
 import logging
 import time
+import orjson
 from app.models.chat import ChatMessage, ChatRequest, ChatResponse
-from app.services.ai_providers import AIProviderService
+from app.services.ai_providers import AIProviderService, get_ai_service
 from app.services.plugin_executor import PluginExecutor
 
 # 设置日志
@@ -28,6 +30,10 @@ class ConnectionManager:
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
+    async def send_json_message(self, payload: Dict[str, Any], websocket: WebSocket):
+        """用 orjson 序列化一次后按文本帧发送（输出 UTF-8，不转义中文）"""
+        await websocket.send_text(orjson.dumps(payload).decode())
+
 manager = ConnectionManager()
 
 async def _handle_function_calling(
@@ -165,7 +171,7 @@ async def _handle_function_calling(
     logger.info(f"[{request_id}] Function calling完成，共执行 {iteration + 1} 轮")
     return current_response
 
-@router.post("/completion")
+@router.post("/completion", response_class=ORJSONResponse)
 async def chat_completion(request: ChatRequest):
     """处理聊天完成请求，支持多种AI提供商"""
     start_time = time.time()
@@ -192,7 +198,7 @@ async def chat_completion(request: ChatRequest):
     
     try:
         logger.info(f"[{request_id}] 开始调用AI服务...")
-        ai_service = AIProviderService()
+        ai_service = get_ai_service()
         plugin_executor = PluginExecutor()
 
         # 获取初始响应
@@ -207,7 +213,8 @@ async def chat_completion(request: ChatRequest):
             reasoning=request.reasoning,
             tools=[tool.dict() for tool in request.tools] if request.tools else None,
             use_native_search=request.use_native_search,
-            base_url=request.base_url
+            base_url=request.base_url,
+            bypass_cache=request.regenerate
         )
 
         # 处理function calling（如果有）
@@ -286,7 +293,8 @@ async def chat_completion(request: ChatRequest):
             
         cleaned_response["usage"] = cleaned_usage
         
-        return cleaned_response
+        # 直接返回 ORJSONResponse，跳过 FastAPI 的 jsonable_encoder 遍历（响应已是纯 JSON 数据）
+        return ORJSONResponse(cleaned_response)
         
     except HTTPException:
         # 重新抛出HTTP异常
@@ -314,25 +322,25 @@ async def websocket_chat(websocket: WebSocket):
     try:
         while True:
             data = await websocket.receive_text()
-            request_data = json.loads(data)
+            request_data = orjson.loads(data)
             
             # Handle heartbeat messages
             if request_data.get("type") == "heartbeat":
-                logger.debug(f"收到心跳消息，时间戳: {request_data.get('timestamp')}")
+                logger.debug("收到心跳消息，时间戳: %s", request_data.get('timestamp'))
                 # Send heartbeat response
-                await manager.send_personal_message(
-                    json.dumps({
+                await manager.send_json_message(
+                    {
                         "type": "heartbeat", 
                         "timestamp": request_data.get("timestamp"),
                         "server_time": time.time() * 1000
-                    }), 
+                    }, 
                     websocket
                 )
                 continue
             
-            logger.info(f"WebSocket收到请求: {request_data.get('provider', 'unknown')}")
+            logger.info("WebSocket收到请求: %s", request_data.get('provider', 'unknown'))
             
-            ai_service = AIProviderService()
+            ai_service = get_ai_service()
             
             async for chunk in ai_service.stream_completion(
                 provider=request_data["provider"],
@@ -343,12 +351,10 @@ async def websocket_chat(websocket: WebSocket):
                 reasoning_summaries=request_data.get("reasoning_summaries", "auto"),
                 reasoning=request_data.get("reasoning", "medium"),
                 tools=request_data.get("tools"),
-                use_native_search=request_data.get("use_native_search")
+                use_native_search=request_data.get("use_native_search"),
+                bypass_cache=request_data.get("regenerate", False)
             ):
-                await manager.send_personal_message(
-                    json.dumps(chunk), 
-                    websocket
-                )
+                await manager.send_json_message(chunk, websocket)
                 
     except WebSocketDisconnect:
         logger.info("WebSocket客户端断开连接")
@@ -356,10 +362,7 @@ async def websocket_chat(websocket: WebSocket):
     except Exception as e:
         logger.error(f"WebSocket处理错误: {str(e)}", exc_info=True)
         try:
-            await manager.send_personal_message(
-                json.dumps({"error": str(e)}), 
-                websocket
-            )
+            await manager.send_json_message({"error": str(e)}, websocket)
         except:
             pass
         manager.disconnect(websocket)
\ No newline at end of file
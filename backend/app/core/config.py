@@ -8,6 +8,19 @@ class Settings(BaseSettings):
     
     # API Keys
     openai_api_key: Optional[str] = None
+
+    # OpenAI SDK 使用 aiohttp 传输层（高并发场景；不支持 HTTP/2，默认使用 httpx HTTP/2）
+    openai_aiohttp_transport: bool = False
+
+    # OpenAI / Anthropic SDK 共享连接池的大小和空闲连接保持时间（秒）
+    provider_max_connections: int = 200
+    provider_max_keepalive_connections: int = 100
+    provider_keepalive_expiry: float = 60.0
+
+    # 非流式对话响应缓存（精确匹配，默认关闭）
+    response_cache_enabled: bool = False
+    response_cache_ttl: int = 3600
+    response_cache_max_entries: int = 512
     
     class Config:
         env_file = ".env"
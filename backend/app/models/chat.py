@@ -5,6 +5,7 @@ class ImageContent(BaseModel):
     type: str = "image"
     data: str  # base64 encoded image data
     mime_type: str  # image/jpeg, image/png, etc.
+    openai_file_id: Optional[str] = None  # 已上传到 OpenAI Files API 时直接引用
 
 class FileContent(BaseModel):
     filename: str
@@ -49,6 +50,7 @@ class ChatRequest(BaseModel):
     tools: Optional[List[ToolConfig]] = None
     use_native_search: Optional[bool] = None
     base_url: Optional[str] = None  # OpenAI兼容提供商的自定义base_url
+    regenerate: bool = False  # 重新生成回复时跳过响应缓存
 
 class Usage(BaseModel):
     prompt_tokens: Optional[int] = 0
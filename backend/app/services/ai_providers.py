@@ -1,167 +1,452 @@
 import openai
 import anthropic
 from google import genai
-from typing import Dict, List, Any, AsyncGenerator, Union, Tuple
+from google.genai import errors as genai_errors
+from typing import Dict, List, Any, AsyncGenerator, Union, Tuple, Optional
 import asyncio
 import logging
-import json
+import orjson
 import os
 import time
 import base64
+import hashlib
+import random
+import secrets
 import httpx
 import warnings
+from functools import lru_cache
+import aiofiles
+from collections import OrderedDict
 from .web_search_service import WebSearchService
+from .response_cache import ResponseCache
+from .response_format import (
+    RESPONSES_IGNORED_STREAM_EVENTS,
+    RESPONSES_STREAM_EVENT_HANDLERS,
+    anthropic_blocks_to_message,
+    convert_responses_to_chat_format
+)
+from ..core.config import get_settings
 
 # 禁用 Pydantic 序列化警告
 warnings.filterwarnings('ignore', category=UserWarning, module='pydantic')
 
 logger = logging.getLogger(__name__)
 
+class _ObjView:
+    """Pydantic 等对象的只读视图，提供与 dict 相同的 get 接口"""
+    __slots__ = ("_m",)
+
+    def __init__(self, msg: Any):
+        self._m = msg
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self._m, key, default)
+
+
+def _msg_view(msg: Union[Dict[str, Any], Any]) -> Union[Dict[str, Any], _ObjView]:
+    """消息的只读视图：构造时判断一次类型，之后统一用 get 读取字段
+
+    字典本身就支持 get，直接返回原字典（不分配包装对象，get 时也没有类型分支）；
+    其他对象包装为 _ObjView。
+    """
+    if isinstance(msg, dict):
+        return msg
+    return _ObjView(msg)
+
+
+def _redact_for_log(obj: Any) -> Any:
+    """生成用于日志的副本：base64 data URL 替换为长度占位，过长的输入文本截断"""
+    if isinstance(obj, dict):
+        redacted = {key: _redact_for_log(value) for key, value in obj.items()}
+        text = redacted.get("text")
+        if redacted.get("type") == "input_text" and isinstance(text, str) and len(text) > 512:
+            redacted["text"] = f"{text[:512]}...<{len(text)} chars>"
+        return redacted
+    if isinstance(obj, list):
+        return [_redact_for_log(item) for item in obj]
+    if isinstance(obj, str) and len(obj) > 128 and obj.startswith("data:"):
+        return f"<base64 {len(obj)} bytes>"
+    return obj
+
+
+class _LazyJson:
+    """日志参数包装：只有日志真正输出时才序列化为紧凑 JSON（图片数据等大字段已脱敏）"""
+    __slots__ = ("_obj",)
+
+    def __init__(self, obj: Any):
+        self._obj = obj
+
+    def __str__(self) -> str:
+        return orjson.dumps(_redact_for_log(self._obj), default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _msg_get(msg: Union[Dict[str, Any], Any], key: str, default: Any = None) -> Any:
+    """读取单个字段（字典或 Pydantic 对象），只读一个字段时无需构造视图"""
+    if isinstance(msg, dict):
+        return msg.get(key, default)
+    return getattr(msg, key, default)
+
+
+def _as_message_dicts(messages: List[Union[Dict[str, Any], Any]]) -> List[Dict[str, Any]]:
+    """把 Pydantic 消息一次性转换为字典（字典原样保留），之后统一按字典读取字段
+
+    去掉值为 None 的字段，纯文本消息转换后只剩 role/content，可以走转换函数的快速路径。
+    """
+    return [msg if isinstance(msg, dict) else msg.model_dump(exclude_none=True) for msg in messages]
+
+
 class AIProviderService:
+    # 服务无请求级状态，实例只保存这两个属性；常量和缓存都放在类级别
+    __slots__ = ("_models_config", "web_search_service")
+
+    # 设置不同操作的超时时间
+    default_timeout = 60  # 默认60秒超时
+    responses_api_timeout = 300  # Responses API 使用更长的超时时间（5分钟），支持深度推理
+    config_timeout = 5  # 配置加载超时缩短到5秒
+    max_retries = 2  # 最大重试次数
+    sdk_max_retries = 3  # SDK 内置重试次数（429/5xx/连接错误，指数退避+抖动）
+    max_concurrent_requests = 8  # 批量调用时的最大并发数
+    stream_coalesce_delay = 0.015  # 流式文本增量最多合并等待的时间（秒）
+    stream_coalesce_chars = 64  # 合并的文本增量达到该长度时立即发送
+
     # 类级别的缓存,所有实例共享
     _models_config_cache = None
     _config_cache_time = 0
     _config_cache_ttl = 600  # 10分钟缓存
+    _config_disk_cache_ttl = 24 * 3600  # 磁盘缓存24小时有效
+    _config_disk_cache_path = os.path.join(os.path.expanduser("~"), ".cache", "minechatweb", "models-config.json")
+    _models_config_url = "https://raw.githubusercontent.com/marvinli001/MineChatWeb/main/models-config.json"
+    _config_lock = None
+    _config_refresh_task = None
+
+    # 由模型配置派生的索引，配置对象变化（重新加载）时重建
+    _model_index_source = None
+    _responses_api_models = frozenset()
+    _streaming_models = {}
+
+    # 已安装的 OpenAI SDK 是否提供 Responses API（导入时检查一次）
+    _HAS_RESPONSES_API = hasattr(openai.AsyncOpenAI, "responses")
+
+    # 共享的 HTTP/2 客户端，所有 OpenAI SDK 实例复用同一个连接池
+    _openai_http_client = None
+
+    # 按 (API Key, base_url, 超时) 缓存的 OpenAI 客户端（LRU，底层共享 _openai_http_client 连接池）
+    _openai_clients: "OrderedDict[Tuple[str, Optional[str], float], openai.AsyncOpenAI]" = OrderedDict()
+
+    # 共享的 HTTP/2 客户端，所有 Anthropic SDK 实例复用同一个连接池
+    _anthropic_http_client = None
+
+    # 按 API Key 缓存的 Anthropic 客户端（LRU，底层共享 _anthropic_http_client 连接池）
+    _anthropic_clients: "OrderedDict[str, anthropic.AsyncAnthropic]" = OrderedDict()
+
+    # 按 API Key 缓存的 Google GenAI 客户端（LRU，复用各自的连接池）
+    _genai_clients: "OrderedDict[str, genai.Client]" = OrderedDict()
+    _client_cache_size = 128
+
+    # 共享的通用出站 HTTP/2 客户端（模型配置拉取等），复用连接避免每次重新握手
+    _outbound_http_client = None
+
+    # 非流式响应缓存（由配置开启，进程内共享）
+    _response_cache = None
+
+    # 消息角色到 Gemini contents 角色的映射（system 单独处理）
+    _GEMINI_ROLE_MAP = {"user": "user", "assistant": "model"}
+
+    # 各提供商停止原因到 OpenAI finish_reason 的映射
+    _ANTHROPIC_STOP_REASONS = {
+        "end_turn": "stop",
+        "max_tokens": "length",
+        "tool_use": "tool_calls",
+        "mcp_tool_use": "mcp_tool_calls"
+    }
+    _GEMINI_FINISH_REASONS = {
+        "STOP": "stop",
+        "MAX_TOKENS": "length",
+        "SAFETY": "content_filter",
+        "RECITATION": "content_filter",
+        "OTHER": "stop"
+    }
+
+    # reasoning 级别对应的 Gemini thinking budget
+    _THINKING_BUDGETS = {"low": 1000, "medium": 5000, "high": 10000}
+
+    # 模型名单（frozenset 常量，成员判断为 O(1) 且不必每次调用重新构造列表）
+    _THINKING_MODELS = frozenset({
+        'o1', 'o1-preview', 'o1-mini', 'o1-pro',
+        'o3', 'o3-mini', 'o3-pro',
+        'o4-mini', 'o4-mini-high'
+    })
+    # 配置加载失败时的回退名单
+    _FALLBACK_RESPONSES_MODELS = frozenset({
+        'chatgpt-4o-latest',
+        'gpt-4o-realtime-preview',
+        'gpt-4o-realtime-preview-2024-10-01',
+        'gpt-5', 'gpt-5.1', 'gpt-5-mini', 'gpt-5-nano', 'gpt-5-chat-latest',
+        'gpt-4o', 'gpt-4o-mini',
+        'gpt-4.1', 'gpt-4.1-mini', 'gpt-4.1-nano',
+        'o1', 'o1-preview', 'o1-mini', 'o3', 'o3-mini', 'o4-mini'
+    })
+    _FALLBACK_NON_STREAMING_MODELS = frozenset({'o1', 'o1-preview', 'o1-mini', 'o3', 'o3-mini', 'o4-mini'})
+    # GPT-5 系列模型名前缀（startswith 接受元组，一次调用完成全部前缀匹配）
+    _GPT5_MODEL_PREFIXES = ("gpt-5",)
+
+    # 提供商 -> 流式调用方法名（各方法参数顺序一致：model, messages, api_key, thinking_mode,
+    # reasoning_summaries, reasoning, tools, use_native_search）
+    _STREAM_METHODS = {
+        "openai": "_openai_stream_completion",
+        "anthropic": "_anthropic_stream_completion",
+        "google": "_google_stream_completion_websocket",
+        "openai_compatible": "_openai_compatible_stream_completion"
+    }
+
+    # 已警告过的未知 Responses API 流式事件类型
+    _unknown_stream_events = set()
+
+    # 流式循环每处理多少个事件主动让出一次事件循环
+    _STREAM_YIELD_EVERY = 32
+
+    # 外层重试循环不再处理的错误：
+    # - OpenAI/Anthropic 的 HTTP 状态错误和连接/超时错误：可恢复的（429/5xx/超时）已由 SDK 按
+    #   sdk_max_retries 重试过，其余（认证失败、权限不足、请求参数错误）重试也无法恢复
+    # - ValueError：请求参数本身有误
+    _NON_RETRYABLE_ERRORS = (
+        openai.APIStatusError,
+        openai.APIConnectionError,
+        anthropic.APIStatusError,
+        anthropic.APIConnectionError,
+        ValueError
+    )
+
+    # 纯文本消息字典的键集合（这类消息转换时可直接复用原字典）
+    _TEXT_MESSAGE_KEYS = frozenset({"role", "content"})
+
+    # 可能通过 Files API 引用文件的 Anthropic 内容块类型
+    _FILES_API_BLOCK_TYPES = frozenset({"image", "document"})
+
+    # 可作为 base64 document 发送给 Anthropic 的非 text/* 文本类 MIME 类型
+    _ANTHROPIC_TEXT_DOCUMENT_MIMES = frozenset({"application/json", "application/xml"})
+
+    # 直接透传到工具配置的字段
+    _IMAGE_GENERATION_PASSTHROUGH_KEYS = (
+        "size", "quality", "background", "partial_images", "input_fidelity", "input_image_mask"
+    )
+    _OPENAI_MCP_PASSTHROUGH_KEYS = ("authorization", "allowed_tools")
+
+    # OpenAI MCP 服务器允许的 URL 前缀（HTTPS 或本地测试地址）
+    _OPENAI_MCP_URL_PREFIXES = ("https://", "http://localhost", "http://127.0.0.1")
 
     def __init__(self):
-        # 设置不同操作的超时时间
-        self.default_timeout = 60  # 默认60秒超时
-        self.responses_api_timeout = 300  # Responses API 使用更长的超时时间（5分钟），支持深度推理
-        self.config_timeout = 5  # 配置加载超时缩短到5秒
-        self.max_retries = 2  # 最大重试次数
         self._models_config = None
         self.web_search_service = WebSearchService()  # 初始化搜索服务
         
-    def _get_message_attr(self, msg: Union[Dict[str, Any], Any], attr: str) -> str:
-        """安全地获取消息属性，支持字典和Pydantic对象"""
-        if isinstance(msg, dict):
-            return msg.get(attr, "")
+    @classmethod
+    def _get_openai_http_client(cls) -> httpx.AsyncClient:
+        """获取共享的 OpenAI SDK HTTP 客户端
+
+        默认使用 HTTP/2 httpx 客户端（并发请求在同一连接上多路复用）；
+        开启 openai_aiohttp_transport 时改用 aiohttp 传输层以支撑更高并发。
+        """
+        if cls._openai_http_client is None or cls._openai_http_client.is_closed:
+            settings = get_settings()
+            if settings.openai_aiohttp_transport:
+                # aiohttp 传输层没有 HTTP/2 多路复用，并发流各占一个连接，连接池需要更大
+                cls._openai_http_client = openai.DefaultAioHttpClient(
+                    limits=httpx.Limits(
+                        max_connections=2000,
+                        max_keepalive_connections=1000,
+                        keepalive_expiry=settings.provider_keepalive_expiry
+                    )
+                )
+            else:
+                cls._openai_http_client = openai.DefaultAsyncHttpxClient(
+                    http2=True,
+                    limits=cls._provider_http_limits()
+                )
+            # 缓存的 OpenAI 客户端仍引用旧的连接池，需要重新创建
+            cls._openai_clients.clear()
+        return cls._openai_http_client
+
+    @classmethod
+    def _get_anthropic_http_client(cls) -> httpx.AsyncClient:
+        """获取共享的 Anthropic SDK HTTP/2 客户端（并发流式请求在同一连接上多路复用）"""
+        if cls._anthropic_http_client is None or cls._anthropic_http_client.is_closed:
+            cls._anthropic_http_client = anthropic.DefaultAsyncHttpxClient(
+                http2=True,
+                limits=cls._provider_http_limits()
+            )
+            # 缓存的 Anthropic 客户端仍引用旧的连接池，需要重新创建
+            cls._anthropic_clients.clear()
+        return cls._anthropic_http_client
+
+    @staticmethod
+    def _provider_http_limits() -> httpx.Limits:
+        """模型提供商连接池的大小和空闲连接保持时间（由配置决定）"""
+        settings = get_settings()
+        return httpx.Limits(
+            max_connections=settings.provider_max_connections,
+            max_keepalive_connections=settings.provider_max_keepalive_connections,
+            keepalive_expiry=settings.provider_keepalive_expiry
+        )
+
+    @classmethod
+    def _get_outbound_http_client(cls) -> httpx.AsyncClient:
+        """获取共享的通用出站 HTTP 客户端"""
+        if cls._outbound_http_client is None or cls._outbound_http_client.is_closed:
+            cls._outbound_http_client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            )
+        return cls._outbound_http_client
+
+    @classmethod
+    def _get_openai_client(cls, api_key: str, base_url: str = None, timeout: float = None) -> openai.AsyncOpenAI:
+        """获取（必要时创建）对应 API Key、base_url 和超时的 OpenAI 客户端"""
+        http_client = cls._get_openai_http_client()
+        timeout = timeout or cls.default_timeout
+        key = (api_key, base_url, timeout)
+        clients = cls._openai_clients
+        client = clients.get(key)
+        if client is None:
+            client = openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=timeout,
+                max_retries=cls.sdk_max_retries,
+                http_client=http_client
+            )
+            clients[key] = client
+            # 超出容量时淘汰最久未使用的客户端（连接池是共享的，不能单独关闭）
+            if len(clients) > cls._client_cache_size:
+                clients.popitem(last=False)
         else:
-            # Pydantic对象，使用属性访问
-            return getattr(msg, attr, "")
-    
-    def _convert_message_to_openai_format(self, msg: Union[Dict[str, Any], Any]) -> Dict[str, Any]:
-        """将消息转换为OpenAI API格式，支持图片和文件附件"""
-        role = self._get_message_attr(msg, "role")
-        content = self._get_message_attr(msg, "content")
-        
-        # 获取图片数据
-        images = None
-        if isinstance(msg, dict):
-            images = msg.get("images")
+            clients.move_to_end(key)
+        return client
+
+    @classmethod
+    def _get_anthropic_client(cls, api_key: str) -> anthropic.AsyncAnthropic:
+        """获取（必要时创建）该 API Key 对应的 Anthropic 客户端"""
+        http_client = cls._get_anthropic_http_client()
+        clients = cls._anthropic_clients
+        client = clients.get(api_key)
+        if client is None:
+            client = anthropic.AsyncAnthropic(
+                api_key=api_key,
+                timeout=cls.default_timeout,
+                max_retries=cls.sdk_max_retries,
+                http_client=http_client
+            )
+            clients[api_key] = client
+            # 超出容量时淘汰最久未使用的客户端（连接池是共享的，不能单独关闭）
+            if len(clients) > cls._client_cache_size:
+                clients.popitem(last=False)
         else:
-            images = getattr(msg, "images", None)
-        
-        # 获取文件数据
-        files = None
-        if isinstance(msg, dict):
-            files = msg.get("files")
+            clients.move_to_end(api_key)
+        return client
+
+    @classmethod
+    def _get_genai_client(cls, api_key: str) -> genai.Client:
+        """获取（必要时创建）该 API Key 对应的 Google GenAI 客户端"""
+        clients = cls._genai_clients
+        client = clients.get(api_key)
+        if client is None:
+            client = genai.Client(api_key=api_key)
+            clients[api_key] = client
+            # 超出容量时淘汰最久未使用的客户端（可能仍有请求在用，交给垃圾回收释放）
+            if len(clients) > cls._client_cache_size:
+                clients.popitem(last=False)
         else:
-            files = getattr(msg, "files", None)
-        
-        # 检查是否有多媒体内容
-        has_multimedia = (images and len(images) > 0) or (files and len(files) > 0)
-        
-        # 如果没有多媒体内容，使用传统格式
-        if not has_multimedia:
-            return {"role": role, "content": content}
-        
-        # 构造支持多媒体的消息格式
-        content_parts = []
-        
-        # 添加文本内容（如果有）
-        if content and content.strip():
-            content_parts.append({"type": "text", "text": content})
-        
-        # 添加图片内容
-        if images:
-            for image in images:
-                if isinstance(image, dict):
-                    image_data = image.get("data")
-                    mime_type = image.get("mime_type", "image/jpeg")
-                else:
-                    image_data = getattr(image, "data", "")
-                    mime_type = getattr(image, "mime_type", "image/jpeg")
-                
-                if image_data:
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{image_data}"
-                        }
-                    })
-        
-        # 添加文件内容 (使用input_file格式)
-        if files:
-            for file in files:
-                if isinstance(file, dict):
-                    file_id = file.get("openai_file_id")
-                    filename = file.get("filename")
-                    process_mode = file.get("process_mode", "direct")
-                else:
-                    file_id = getattr(file, "openai_file_id", "")
-                    filename = getattr(file, "filename", "")
-                    process_mode = getattr(file, "process_mode", "direct")
-                
-                if file_id:
-                    # 根据处理模式决定如何处理文件
-                    if process_mode == "direct":
-                        # 直读模式：使用 input_file
-                        content_parts.append({
-                            "type": "input_file",
-                            "file_id": file_id
-                        })
-                    # Code Interpreter 和 File Search 模式的文件会在工具配置中处理
-        
-        return {
-            "role": role,
-            "content": content_parts
-        }
+            clients.move_to_end(api_key)
+        return client
+
+    @classmethod
+    async def close_http_clients(cls):
+        """关闭共享的 HTTP 客户端（应用关闭时调用）"""
+        for client in (cls._openai_http_client, cls._anthropic_http_client, cls._outbound_http_client):
+            if client is not None and not client.is_closed:
+                await client.aclose()
+        cls._openai_http_client = None
+        cls._anthropic_http_client = None
+        cls._outbound_http_client = None
+        cls._openai_clients.clear()
+        cls._anthropic_clients.clear()
+
+        # 较早版本的 google-genai 没有 aclose，此时交给垃圾回收释放
+        for client in cls._genai_clients.values():
+            aclose = getattr(client.aio, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        cls._genai_clients.clear()
+
+    @classmethod
+    def _get_response_cache(cls) -> Optional[ResponseCache]:
+        """获取响应缓存，未开启时返回 None"""
+        settings = get_settings()
+        if not settings.response_cache_enabled:
+            return None
+        if cls._response_cache is None:
+            cls._response_cache = ResponseCache(
+                max_entries=settings.response_cache_max_entries,
+                ttl=settings.response_cache_ttl
+            )
+        return cls._response_cache
+
+    def _message_parts(self, msg: Union[Dict[str, Any], Any]) -> Tuple[str, Any]:
+        """一次性获取消息的 role 和 content，避免重复的类型判断"""
+        if isinstance(msg, dict):
+            return msg.get("role", ""), msg.get("content", "")
+        return getattr(msg, "role", ""), getattr(msg, "content", "")
 
     def _convert_message_to_responses_input(
         self,
         msg: Union[Dict[str, Any], Any]
     ) -> Tuple[Dict[str, Any], bool]:
         """????????Responses API??????????????"""
-        role = self._get_message_attr(msg, "role")
-        content = self._get_message_attr(msg, "content") or ""
+        # 快速路径：只有 role/content 的纯文本字典无需转换
+        if isinstance(msg, dict) and msg.keys() == self._TEXT_MESSAGE_KEYS and isinstance(msg["content"], str):
+            return msg, False
+
+        view = _msg_view(msg)
+        role = view.get("role", "")
+        content = view.get("content") or ""
 
-        images = msg.get("images") if isinstance(msg, dict) else getattr(msg, "images", None)
-        files = msg.get("files") if isinstance(msg, dict) else getattr(msg, "files", None)
+        images = view.get("images")
+        files = view.get("files")
 
         has_structured_content = False
         content_parts: List[Dict[str, Any]] = []
+        append = content_parts.append
 
-        text_part = {"type": "input_text", "text": content} if content.strip() else None
+        text_part = {"type": "input_text", "text": content} if content and not content.isspace() else None
 
         if images:
             has_structured_content = True
             for image in images:
-                if isinstance(image, dict):
-                    image_data = image.get("data")
-                    mime_type = image.get("mime_type", "image/jpeg")
-                else:
-                    image_data = getattr(image, "data", "")
-                    mime_type = getattr(image, "mime_type", "image/jpeg")
-
-                if image_data:
-                    content_parts.append({
+                image = _msg_view(image)
+                image_file_id = image.get("openai_file_id")
+                image_data = image.get("data")
+                mime_type = image.get("mime_type", "image/jpeg")
+
+                if image_file_id:
+                    # 已上传到 Files API 的图片直接引用，避免重复传输 base64
+                    append({
+                        "type": "input_image",
+                        "file_id": image_file_id
+                    })
+                elif image_data:
+                    append({
                         "type": "input_image",
                         "image_url": f"data:{mime_type};base64,{image_data}"
                     })
 
         if files:
             for file in files:
-                if isinstance(file, dict):
-                    openai_file_id = file.get("openai_file_id")
-                    process_mode = file.get("process_mode", "direct")
-                else:
-                    openai_file_id = getattr(file, "openai_file_id", None)
-                    process_mode = getattr(file, "process_mode", "direct")
+                file = _msg_view(file)
+                openai_file_id = file.get("openai_file_id")
+                process_mode = file.get("process_mode", "direct")
 
                 if openai_file_id and process_mode == "direct":
                     has_structured_content = True
-                    content_parts.append({
+                    append({
                         "type": "input_file",
                         "file_id": openai_file_id
                     })
@@ -170,7 +455,7 @@ class AIProviderService:
             if text_part:
                 content_parts.insert(0, text_part)
             elif not content_parts:
-                content_parts.append({"type": "input_text", "text": ""})
+                append({"type": "input_text", "text": ""})
 
             return {"role": role, "content": content_parts}, True
 
@@ -185,35 +470,48 @@ class AIProviderService:
 
     def _prepare_openai_tools_config(self, messages: List[Union[Dict[str, Any], Any]], tools: List[Dict[str, Any]] = None) -> Dict[str, Any]:
         """准备OpenAI工具配置"""
-        tools_config = {"tools": []}
-
         # 收集所有需要的工具
         need_code_interpreter = False
-        need_file_search = False
         vector_stores = set()
 
         for msg in messages:
-            # 获取文件数据
-            files = None
-            if isinstance(msg, dict):
-                files = msg.get("files")
-            else:
-                files = getattr(msg, "files", None)
-
-            if files:
-                for file in files:
-                    if isinstance(file, dict):
-                        process_mode = file.get("process_mode", "direct")
-                        vector_store_id = file.get("vector_store_id")
-                    else:
-                        process_mode = getattr(file, "process_mode", "direct")
-                        vector_store_id = getattr(file, "vector_store_id", None)
-
-                    if process_mode == "code_interpreter":
-                        need_code_interpreter = True
-                    elif process_mode == "file_search" and vector_store_id:
-                        need_file_search = True
-                        vector_stores.add(vector_store_id)
+            files = _msg_get(msg, "files")
+            if files and self._collect_file_tools(files, vector_stores):
+                need_code_interpreter = True
+
+        return self._build_openai_tools_config(need_code_interpreter, vector_stores, tools)
+
+    @staticmethod
+    def _find_tool(tools: Optional[List[Dict[str, Any]]], tool_type: str) -> Optional[Dict[str, Any]]:
+        """返回工具列表中第一个指定类型的工具，没有时返回 None"""
+        for tool in tools or ():
+            if tool.get("type") == tool_type:
+                return tool
+        return None
+
+    @staticmethod
+    def _collect_file_tools(files: List[Any], vector_stores: set) -> bool:
+        """收集文件所需的工具：file_search 的向量库 ID 加入 vector_stores，返回是否需要 Code Interpreter"""
+        need_code_interpreter = False
+        for file in files:
+            file = _msg_view(file)
+            process_mode = file.get("process_mode", "direct")
+            if process_mode == "code_interpreter":
+                need_code_interpreter = True
+            elif process_mode == "file_search":
+                vector_store_id = file.get("vector_store_id")
+                if vector_store_id:
+                    vector_stores.add(vector_store_id)
+        return need_code_interpreter
+
+    def _build_openai_tools_config(
+        self,
+        need_code_interpreter: bool,
+        vector_stores: set,
+        tools: List[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """根据文件工具需求和前端工具配置构建OpenAI工具配置"""
+        tools_config = {"tools": []}
 
         # 添加需要的工具
         if need_code_interpreter:
@@ -222,7 +520,7 @@ class AIProviderService:
                 "container": {"type": "auto"}
             })
 
-        if need_file_search and vector_stores:
+        if vector_stores:
             tools_config["tools"].append({
                 "type": "file_search",
                 "vector_store_ids": list(vector_stores)
@@ -271,7 +569,7 @@ class AIProviderService:
     
     def _build_image_generation_tool_config(self, tool_config: Dict[str, Any]) -> Dict[str, Any]:
         """构建图片生成工具配置（Responses API）"""
-        logger.info(f"构建图片生成工具配置，输入: {tool_config}")
+        logger.info("构建图片生成工具配置，输入: %s", tool_config)
 
         config = {
             "type": "image_generation"
@@ -279,31 +577,12 @@ class AIProviderService:
 
         # 添加 Responses API 支持的图片生成参数
         # 注意：format 和 compression 只在 Image API 中支持，不在 Responses API 中支持
-        if "size" in tool_config:
-            config["size"] = tool_config["size"]
-
-        if "quality" in tool_config:
-            config["quality"] = tool_config["quality"]
-
-        if "background" in tool_config:
-            config["background"] = tool_config["background"]
+        config.update({key: tool_config[key] for key in self._IMAGE_GENERATION_PASSTHROUGH_KEYS if key in tool_config})
 
-        if "partial_images" in tool_config:
-            config["partial_images"] = tool_config["partial_images"]
+        # 默认设置审核级别为low（如用户要求）
+        config["moderation"] = tool_config["moderation"] if "moderation" in tool_config else "low"
 
-        if "input_fidelity" in tool_config:
-            config["input_fidelity"] = tool_config["input_fidelity"]
-
-        if "input_image_mask" in tool_config:
-            config["input_image_mask"] = tool_config["input_image_mask"]
-
-        if "moderation" in tool_config:
-            config["moderation"] = tool_config["moderation"]
-        else:
-            # 默认设置审核级别为low（如用户要求）
-            config["moderation"] = "low"
-
-        logger.info(f"图片生成工具配置构建完成: {config}")
+        logger.info("图片生成工具配置构建完成: %s", config)
         return config
 
     def _build_function_calling_tool_config(self, tool_config: Dict[str, Any]) -> Dict[str, Any]:
@@ -351,43 +630,23 @@ class AIProviderService:
             if "server_url" in config:
                 del config["server_url"]
 
-        # 授权配置
-        if "authorization" in tool_config:
-            config["authorization"] = tool_config["authorization"]
-
-        # 审批要求配置（支持细粒度控制）
-        if "require_approval" in tool_config:
-            require_approval = tool_config["require_approval"]
-            if isinstance(require_approval, dict):
-                # 支持对象格式: {"never": {"tool_names": ["safe_tool"]}}
-                config["require_approval"] = require_approval
-            else:
-                # 支持字符串格式: "always", "never"
-                config["require_approval"] = require_approval
-        else:
-            # 默认总是需要审批（安全考虑）
-            config["require_approval"] = "always"
+        # 授权配置、允许的工具列表
+        config.update({key: tool_config[key] for key in self._OPENAI_MCP_PASSTHROUGH_KEYS if key in tool_config})
 
-        # 允许的工具列表
-        if "allowed_tools" in tool_config:
-            config["allowed_tools"] = tool_config["allowed_tools"]
+        # 审批要求配置，支持字符串格式 "always"/"never" 或对象格式
+        # {"never": {"tool_names": ["safe_tool"]}}；默认总是需要审批（安全考虑）
+        config["require_approval"] = tool_config["require_approval"] if "require_approval" in tool_config else "always"
 
         return config
 
     def _handle_mcp_approval_message(self, msg: Union[Dict[str, Any], Any]) -> Dict[str, Any]:
         """处理MCP审批响应消息（OpenAI格式）"""
-        if isinstance(msg, dict):
-            approval_data = {
-                "type": "mcp_approval_response",
-                "approve": msg.get("approve", True),
-                "approval_request_id": msg.get("approval_request_id")
-            }
-        else:
-            approval_data = {
-                "type": "mcp_approval_response",
-                "approve": getattr(msg, "approve", True),
-                "approval_request_id": getattr(msg, "approval_request_id", "")
-            }
+        view = _msg_view(msg)
+        approval_data = {
+            "type": "mcp_approval_response",
+            "approve": view.get("approve", True),
+            "approval_request_id": view.get("approval_request_id")
+        }
 
         return {
             "role": "user",
@@ -405,7 +664,7 @@ class AIProviderService:
             return False
 
         # OpenAI推荐使用HTTPS
-        if provider == "openai" and not url.startswith(("https://", "http://localhost", "http://127.0.0.1")):
+        if provider == "openai" and not url.startswith(self._OPENAI_MCP_URL_PREFIXES):
             logger.warning(f"OpenAI MCP服务器URL建议使用HTTPS（除非是本地测试）: {url}")
             return False
 
@@ -435,10 +694,7 @@ class AIProviderService:
         tool_configuration = {}
 
         # 启用状态
-        if "enabled" in tool_config:
-            tool_configuration["enabled"] = tool_config["enabled"]
-        else:
-            tool_configuration["enabled"] = True
+        tool_configuration["enabled"] = tool_config["enabled"] if "enabled" in tool_config else True
 
         # 允许的工具列表
         if "allowed_tools" in tool_config and tool_config["allowed_tools"]:
@@ -449,25 +705,81 @@ class AIProviderService:
 
         return config
 
-    def _find_previous_image_generation(self, messages: List[Union[Dict[str, Any], Any]]) -> str:
-        """查找之前的图片生成结果的ID，用于多轮图像生成"""
-        # 从最近的消息开始向后查找
-        for msg in reversed(messages):
-            role = self._get_message_attr(msg, "role")
+    def _prepare_conversation(
+        self,
+        messages: List[Union[Dict[str, Any], Any]],
+        tools: List[Dict[str, Any]] = None
+    ) -> Tuple[List[Dict[str, Any]], str, Dict[str, Any], str]:
+        """单次遍历消息，同时完成 Responses API 输入转换、文件工具收集和多轮图片生成ID查找
+
+        返回 (input_messages, instructions_text, tools_config, previous_image_gen_id)
+        """
+        input_messages = []
+        append = input_messages.append
+        instructions_text = ""
+        uses_structured_content = False
+        need_code_interpreter = False
+        vector_stores = set()
+        previous_image_gen_id = ""
+
+        for msg in messages:
+            view = _msg_view(msg)
+            role = view.get("role", "")
+
+            if role == "system":
+                instructions_text = view.get("content", "")
+                continue
+
+            if role == "mcp_approval_response":
+                # 处理MCP审批响应（特殊消息类型）
+                append({
+                    "type": "mcp_approval_response",
+                    "approve": view.get("approve", True),
+                    "approval_request_id": view.get("approval_request_id")
+                })
+                uses_structured_content = True
+                continue
+
+            # 记录最近一次图片生成结果（用于多轮图像生成）
             if role == "assistant":
-                # 检查是否有图片生成结果
-                image_generations = None
-                if isinstance(msg, dict):
-                    image_generations = msg.get("image_generations")
+                image_generations = view.get("image_generations")
+                if image_generations:
+                    previous_image_gen_id = image_generations[-1].get("id", "")
+
+            # 收集文件所需的工具
+            files = view.get("files")
+            if files and self._collect_file_tools(files, vector_stores):
+                need_code_interpreter = True
+
+            converted_message, has_structured = self._convert_message_to_responses_input(msg)
+            if has_structured:
+                uses_structured_content = True
+            append(converted_message)
+
+        if uses_structured_content:
+            input_messages = self._normalize_responses_input(input_messages)
+
+        tools_config = self._build_openai_tools_config(need_code_interpreter, vector_stores, tools)
+        return input_messages, instructions_text, tools_config, previous_image_gen_id
+
+    def _normalize_responses_input(self, input_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """结构化输入时，将所有消息的 content 统一为内容部分数组"""
+        normalized_messages: List[Dict[str, Any]] = []
+        for item in input_messages:
+            if isinstance(item, dict) and item.get("role"):
+                content = item.get("content", "")
+                if isinstance(content, list):
+                    if not content:
+                        content = [{"type": "input_text", "text": ""}]
+                    item = {**item, "content": content}
                 else:
-                    image_generations = getattr(msg, "image_generations", None)
-                
-                if image_generations and len(image_generations) > 0:
-                    # 返回最近的图片生成ID
-                    return image_generations[-1].get("id", "")
-        
-        return ""
-    
+                    item = {
+                        **item,
+                        "content": [{"type": "input_text", "text": content or ""}]
+                    }
+            normalized_messages.append(item)
+        return normalized_messages
+
     async def _handle_web_search_fallback(
         self, 
         completion_params: Dict[str, Any], 
@@ -496,44 +808,115 @@ class AIProviderService:
         return completion_params
         
     async def _load_models_config(self, force_refresh: bool = False) -> Dict[str, Any]:
-        """加载模型配置(带缓存)"""
+        """加载模型配置(内存缓存 + 磁盘缓存，过期时后台刷新)"""
+        cls = AIProviderService
         current_time = time.time()
 
-        # 检查缓存是否有效
-        if not force_refresh and AIProviderService._models_config_cache is not None:
-            if current_time - AIProviderService._config_cache_time < AIProviderService._config_cache_ttl:
+        # 检查内存缓存是否有效
+        if not force_refresh and cls._models_config_cache is not None:
+            if current_time - cls._config_cache_time < cls._config_cache_ttl:
                 logger.debug("使用缓存的模型配置")
-                return AIProviderService._models_config_cache
+                return cls._models_config_cache
+            # 内存缓存过期：先返回旧配置，后台刷新
+            self._schedule_models_config_refresh()
+            return cls._models_config_cache
+
+        # 冷启动时优先使用磁盘缓存，避免阻塞在远程请求上
+        if not force_refresh:
+            disk_config, disk_mtime = await self._read_models_config_disk_cache()
+            if disk_config is not None:
+                cls._models_config_cache = disk_config
+                if current_time - disk_mtime < cls._config_disk_cache_ttl:
+                    cls._config_cache_time = current_time
+                    logger.info("成功从磁盘缓存加载模型配置")
+                else:
+                    cls._config_cache_time = disk_mtime
+                    logger.info("磁盘缓存的模型配置已过期，先行使用并在后台刷新")
+                    self._schedule_models_config_refresh()
+                return disk_config
+
+        # 没有可用缓存或强制刷新,从远程加载（加锁避免并发重复请求）
+        async with self._get_models_config_lock():
+            if not force_refresh and cls._models_config_cache is not None:
+                return cls._models_config_cache
+
+            try:
+                return await self._fetch_remote_models_config()
+            except Exception as e:
+                logger.warning(f"从远程加载模型配置失败: {e}")
+
+                # 如果有旧缓存,继续使用
+                if cls._models_config_cache is not None:
+                    logger.info("使用过期的缓存配置")
+                    return cls._models_config_cache
+
+                # 尝试从本地文件加载
+                try:
+                    local_config_path = os.path.join(os.path.dirname(__file__), '../../..', 'models-config.json')
+                    with open(local_config_path, 'rb') as f:
+                        cls._models_config_cache = orjson.loads(f.read())
+                        cls._config_cache_time = current_time
+                        logger.info("成功从本地文件加载模型配置")
+                        return cls._models_config_cache
+                except Exception as local_error:
+                    logger.error(f"从本地文件加载模型配置失败: {local_error}")
+                    raise Exception("无法加载模型配置文件")
+
+    @classmethod
+    def _get_models_config_lock(cls) -> asyncio.Lock:
+        """获取模型配置加载锁（首次使用时创建）"""
+        if cls._config_lock is None:
+            cls._config_lock = asyncio.Lock()
+        return cls._config_lock
+
+    async def _fetch_remote_models_config(self) -> Dict[str, Any]:
+        """从远程拉取模型配置，更新内存缓存并写入磁盘缓存"""
+        client = self._get_outbound_http_client()
+        response = await client.get(self._models_config_url, timeout=self.config_timeout)
+        response.raise_for_status()
+        config = orjson.loads(response.content)
+
+        AIProviderService._models_config_cache = config
+        AIProviderService._config_cache_time = time.time()
+        logger.info("成功从远程加载模型配置并更新缓存")
 
-        # 缓存过期或强制刷新,尝试从远程加载
         try:
-            config_url = "https://raw.githubusercontent.com/marvinli001/MineChatWeb/main/models-config.json"
-            async with httpx.AsyncClient(timeout=self.config_timeout) as client:
-                response = await client.get(config_url)
-                response.raise_for_status()
-                AIProviderService._models_config_cache = response.json()
-                AIProviderService._config_cache_time = current_time
-                logger.info("成功从远程加载模型配置并更新缓存")
-                return AIProviderService._models_config_cache
+            cache_path = AIProviderService._config_disk_cache_path
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            async with aiofiles.open(cache_path, 'wb') as f:
+                await f.write(response.content)
         except Exception as e:
-            logger.warning(f"从远程加载模型配置失败: {e}")
+            logger.warning(f"写入模型配置磁盘缓存失败: {e}")
 
-            # 如果有旧缓存,继续使用
-            if AIProviderService._models_config_cache is not None:
-                logger.info("使用过期的缓存配置")
-                return AIProviderService._models_config_cache
+        return config
 
-            # 尝试从本地文件加载
-            try:
-                local_config_path = os.path.join(os.path.dirname(__file__), '../../..', 'models-config.json')
-                with open(local_config_path, 'r', encoding='utf-8') as f:
-                    AIProviderService._models_config_cache = json.load(f)
-                    AIProviderService._config_cache_time = current_time
-                    logger.info("成功从本地文件加载模型配置")
-                    return AIProviderService._models_config_cache
-            except Exception as local_error:
-                logger.error(f"从本地文件加载模型配置失败: {local_error}")
-                raise Exception("无法加载模型配置文件")
+    async def _read_models_config_disk_cache(self) -> Tuple[Union[Dict[str, Any], None], float]:
+        """读取磁盘缓存的模型配置，返回 (配置, 修改时间)，不存在或损坏时返回 (None, 0)"""
+        cache_path = AIProviderService._config_disk_cache_path
+        try:
+            mtime = os.stat(cache_path).st_mtime
+            async with aiofiles.open(cache_path, 'rb') as f:
+                return orjson.loads(await f.read()), mtime
+        except FileNotFoundError:
+            return None, 0
+        except Exception as e:
+            logger.warning(f"读取模型配置磁盘缓存失败: {e}")
+            return None, 0
+
+    def _schedule_models_config_refresh(self):
+        """在后台刷新模型配置（同一时间只运行一个刷新任务）"""
+        task = AIProviderService._config_refresh_task
+        if task is not None and not task.done():
+            return
+        AIProviderService._config_refresh_task = asyncio.create_task(self._refresh_models_config())
+
+    async def _refresh_models_config(self):
+        """后台刷新任务，失败时保留现有缓存"""
+        try:
+            async with self._get_models_config_lock():
+                await self._fetch_remote_models_config()
+        except Exception as e:
+            logger.warning(f"后台刷新模型配置失败，继续使用缓存: {e}")
         
     async def get_completion(
         self,
@@ -547,11 +930,57 @@ class AIProviderService:
         reasoning: str = "medium",
         tools: List[Dict[str, Any]] = None,
         use_native_search: bool = None,
-        base_url: str = None
+        base_url: str = None,
+        bypass_cache: bool = False
     ) -> Dict[str, Any]:
-        """获取AI完成响应"""
-        logger.info(f"开始调用 {provider} API, 模型: {model}, 思考模式: {thinking_mode}")
-        
+        """获取AI完成响应
+
+        各提供商都按温度采样，bypass_cache 为 True（用户要求重新生成）时不读取缓存，新结果覆盖原有条目。
+        """
+        # 流式请求和带工具的请求结果依赖外部状态，不走缓存
+        cache = None if stream or tools else self._get_response_cache()
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key(
+                provider, model, messages,
+                api_key=api_key,
+                thinking_mode=thinking_mode,
+                reasoning_summaries=reasoning_summaries,
+                reasoning=reasoning,
+                use_native_search=use_native_search,
+                base_url=base_url
+            )
+            cached = None if bypass_cache else cache.get(cache_key)
+            if cached is not None:
+                logger.info("命中响应缓存: %s/%s", provider, model)
+                return cached
+
+        result = await self._get_completion_with_retry(
+            provider, model, messages, api_key, stream, thinking_mode,
+            reasoning_summaries, reasoning, tools, use_native_search, base_url
+        )
+
+        if cache is not None and isinstance(result, dict):
+            cache.put(cache_key, result)
+        return result
+
+    async def _get_completion_with_retry(
+        self,
+        provider: str,
+        model: str,
+        messages: List[Union[Dict[str, str], Any]],
+        api_key: str,
+        stream: bool,
+        thinking_mode: bool,
+        reasoning_summaries: str,
+        reasoning: str,
+        tools: List[Dict[str, Any]],
+        use_native_search: bool,
+        base_url: str
+    ) -> Dict[str, Any]:
+        """带重试的提供商调用"""
+        logger.info("开始调用 %s API, 模型: %s, 思考模式: %s", provider, model, thinking_mode)
+
         # 使用重试机制
         last_exception = None
         for attempt in range(self.max_retries + 1):
@@ -572,7 +1001,7 @@ class AIProviderService:
                 last_exception = e
                 logger.warning(f"{provider} API调用超时 (尝试 {attempt + 1}/{self.max_retries + 1})")
                 if attempt < self.max_retries:
-                    await asyncio.sleep(2 ** attempt)  # 指数退避
+                    await asyncio.sleep(self._retry_delay(attempt))
                     continue
                 else:
                     logger.error(f"{provider} API调用在 {self.max_retries + 1} 次尝试后仍然超时")
@@ -580,12 +1009,12 @@ class AIProviderService:
             except Exception as e:
                 last_exception = e
                 # 对于某些错误类型，不进行重试
-                if any(keyword in str(e).lower() for keyword in ['authentication', 'authorization', 'api key', 'invalid']):
-                    logger.error(f"{provider} API调用失败 (认证错误): {str(e)}")
+                if self._is_non_retryable_error(e):
+                    logger.error(f"{provider} API调用失败 (不可重试): {str(e)}")
                     raise
                 elif attempt < self.max_retries:
                     logger.warning(f"{provider} API调用失败 (尝试 {attempt + 1}/{self.max_retries + 1}): {str(e)}")
-                    await asyncio.sleep(2 ** attempt)  # 指数退避
+                    await asyncio.sleep(self._retry_delay(attempt))
                     continue
                 else:
                     logger.error(f"{provider} API调用在 {self.max_retries + 1} 次尝试后仍然失败: {str(e)}")
@@ -595,54 +1024,122 @@ class AIProviderService:
         if last_exception:
             raise last_exception
 
+    @classmethod
+    def _is_non_retryable_error(cls, exc: BaseException) -> bool:
+        """按异常类型判断是否不应重试（沿 __cause__ 检查被包装的 SDK 异常）"""
+        while exc is not None:
+            if isinstance(exc, cls._NON_RETRYABLE_ERRORS):
+                return True
+            if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in (401, 403):
+                return True
+            if isinstance(exc, genai_errors.ClientError) and exc.code != 429:
+                return True
+            exc = exc.__cause__
+        return False
+
+    @staticmethod
+    def _retry_delay(attempt: int) -> float:
+        """指数退避加随机抖动，避免多个请求同时重试"""
+        return min(30, (2 ** attempt) * random.uniform(0.8, 1.2))
+
+    async def batch_completion(
+        self,
+        provider: str,
+        model: str,
+        messages_list: List[List[Union[Dict[str, str], Any]]],
+        api_key: str,
+        thinking_mode: bool = False,
+        reasoning_summaries: str = "auto",
+        reasoning: str = "medium",
+        tools: List[Dict[str, Any]] = None,
+        use_native_search: bool = None,
+        base_url: str = None
+    ) -> List[Dict[str, Any]]:
+        """并发执行多组独立对话的完成请求，结果顺序与输入一致"""
+        logger.info("开始批量调用 %s API, 模型: %s, 请求数量: %s", provider, model, len(messages_list))
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        async def _run(messages: List[Union[Dict[str, str], Any]]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.get_completion(
+                    provider, model, messages, api_key, False, thinking_mode,
+                    reasoning_summaries, reasoning, tools, use_native_search, base_url
+                )
+
+        return await asyncio.gather(*(_run(messages) for messages in messages_list))
+
+    async def get_completions_parallel(
+        self,
+        reqs: List[Dict[str, Any]],
+        max_concurrency: int = None
+    ) -> List[Union[Dict[str, Any], BaseException]]:
+        """并发执行多个独立的完成请求（可跨提供商/模型），结果顺序与输入一致
+
+        每个请求是 get_completion 的关键字参数字典；单个请求失败时对应位置返回异常对象，
+        不影响其他请求。
+        """
+        logger.info("开始并发调用, 请求数量: %s", len(reqs))
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrent_requests)
+
+        async def _run(req: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.get_completion(**req)
+
+        # 先全部提交再统一等待，避免逐个等待导致请求串行
+        return await asyncio.gather(*(_run(req) for req in reqs), return_exceptions=True)
+
     def _is_thinking_model(self, model: str) -> bool:
         """判断是否为思考模型"""
-        thinking_models = [
-            'o1', 'o1-preview', 'o1-mini', 'o1-pro',
-            'o3', 'o3-mini', 'o3-pro',
-            'o4-mini', 'o4-mini-high'
-        ]
-        return model in thinking_models
+        return model in self._THINKING_MODELS
+
+    @classmethod
+    def _build_model_index(cls, config: Dict[str, Any]):
+        """从模型配置预先计算 Responses API 模型集合和各提供商的流式模型集合"""
+        if config is cls._model_index_source:
+            return
+
+        providers = config.get('providers', {})
+        openai_models = providers.get('openai', {}).get('models', {})
+        cls._responses_api_models = frozenset(
+            name for name, model_config in openai_models.items()
+            if model_config.get('api_type') == 'responses'
+        )
+        cls._streaming_models = {
+            provider: frozenset(
+                name for name, model_config in provider_config.get('models', {}).items()
+                if model_config.get('supports_streaming', False)
+            )
+            for provider, provider_config in providers.items()
+        }
+        cls._model_index_source = config
 
     async def _is_openai_responses_api(self, model: str) -> bool:
         """判断是否为 OpenAI Responses API 模型"""
         try:
             config = await self._load_models_config()  # 添加 await
-            openai_models = config.get('providers', {}).get('openai', {}).get('models', {})
-            model_config = openai_models.get(model, {})
-            return model_config.get('api_type') == 'responses'
+            self._build_model_index(config)
+            return model in self._responses_api_models
         except Exception as e:
             logger.warning(f"无法检查模型API类型: {e}")
             # 回退到硬编码列表
-            fallback_models = [
-                'chatgpt-4o-latest',
-                'gpt-4o-realtime-preview',
-                'gpt-4o-realtime-preview-2024-10-01',
-                'gpt-5', 'gpt-5.1', 'gpt-5-mini', 'gpt-5-nano', 'gpt-5-chat-latest',
-                'gpt-4o', 'gpt-4o-mini',
-                'gpt-4.1', 'gpt-4.1-mini', 'gpt-4.1-nano',
-                'o1', 'o1-preview', 'o1-mini', 'o3', 'o3-mini', 'o4-mini'
-            ]
-            return model in fallback_models
+            return model in self._FALLBACK_RESPONSES_MODELS
 
     async def _supports_streaming(self, provider: str, model: str) -> bool:
         """检查模型是否支持流式输出"""
         try:
             config = await self._load_models_config()  # 添加 await
-            provider_models = config.get('providers', {}).get(provider, {}).get('models', {})
-            model_config = provider_models.get(model, {})
-            return model_config.get('supports_streaming', False)
+            self._build_model_index(config)
+            return model in self._streaming_models.get(provider, ())
         except Exception as e:
             logger.warning(f"无法检查模型流式支持: {e}")
             # 对于OpenAI，除了thinking模型外，默认支持流式
             if provider == 'openai':
-                thinking_models = ['o1', 'o1-preview', 'o1-mini', 'o3', 'o3-mini', 'o4-mini']
-                return model not in thinking_models
+                return model not in self._FALLBACK_NON_STREAMING_MODELS
             return False
 
     def _is_gpt5_model(self, model: str) -> bool:
-        """????? GPT-5 ????"""
-        return model.startswith('gpt-5')
+        """判断是否为 GPT-5 系列模型（gpt-5、gpt-5.1、gpt-5-mini 等）"""
+        return model.startswith(self._GPT5_MODEL_PREFIXES)
 
     def _supports_thinking_mode(self, model: str) -> bool:
         """判断模型是否支持 thinking mode (通过 reasoning_effort 参数)"""
@@ -663,199 +1160,43 @@ class AIProviderService:
 
         return effort_value
 
-
     def _convert_responses_to_chat_format(self, responses_result: Dict[str, Any]) -> Dict[str, Any]:
         """将 Responses API 格式转换为标准 Chat Completions 格式"""
-        if "choices" in responses_result:
-            # 已经是标准格式，直接返回
-            return responses_result
-
-        if "output" not in responses_result:
-            # 不是 Responses API 格式，直接返回
-            return responses_result
+        return convert_responses_to_chat_format(responses_result)
 
-        # 转换 Responses API 格式
-        output = responses_result.get("output", [])
-        choices = []
-        reasoning_content = ""
-        image_generations = []
-        function_calls = []
-        custom_tool_calls = []
-        mcp_list_tools = []
-        mcp_calls = []
-        mcp_approval_requests = []
-
-        # 提取不同类型的输出内容
-        assistant_content = ""
-        finish_reason = "stop"
+    def _convert_text_only_response(self, response: Any) -> Union[Dict[str, Any], None]:
+        """纯文本 Responses API 结果的快速转换，包含工具调用等其他输出时返回 None"""
+        output = getattr(response, "output", None)
+        if not output:
+            return None
 
+        message_count = 0
         for item in output:
-            # 提取推理内容
-            if item.get("type") == "reasoning":
-                summary_items = item.get("summary", [])
-                for summary_item in summary_items:
-                    if summary_item.get("type") == "summary_text":
-                        reasoning_content = summary_item.get("text", "")
-                        break
-
-            # 提取图片生成结果
-            elif item.get("type") == "image_generation_call":
-                image_gen = {
-                    "id": item.get("id"),
-                    "type": "image_generation_call",
-                    "status": item.get("status"),
-                    "result": item.get("result"),
-                    "revised_prompt": item.get("revised_prompt")
-                }
-                image_generations.append(image_gen)
-
-            # 提取function calling结果（根据官方文档格式）
-            elif item.get("type") == "function_call":
-                function_call = {
-                    "id": item.get("call_id", item.get("id")),  # 使用call_id作为主ID
-                    "type": "function",
-                    "function": {
-                        "name": item.get("name"),
-                        "arguments": item.get("arguments", "{}")
-                    }
-                }
-                function_calls.append(function_call)
-                finish_reason = "tool_calls"
-
-            # 提取custom tool calling结果
-            elif item.get("type") == "custom_tool_call":
-                custom_tool_call = {
-                    "id": item.get("id"),
-                    "type": "custom_tool_call",
-                    "name": item.get("name"),
-                    "input": item.get("input", ""),
-                    "call_id": item.get("call_id")
-                }
-                custom_tool_calls.append(custom_tool_call)
-                finish_reason = "tool_calls"
-
-            # 提取MCP工具列表（根据官方文档）
-            elif item.get("type") == "mcp_list_tools":
-                mcp_list_tool = {
-                    "id": item.get("id"),
-                    "type": "mcp_list_tools",
-                    "server_label": item.get("server_label"),
-                    "tools": item.get("tools", [])
-                }
-                mcp_list_tools.append(mcp_list_tool)
-
-            # 提取MCP调用结果
-            elif item.get("type") == "mcp_call":
-                mcp_call = {
-                    "id": item.get("id"),
-                    "type": "mcp_call",
-                    "server_label": item.get("server_label"),
-                    "name": item.get("name"),
-                    "arguments": item.get("arguments"),
-                    "output": item.get("output"),
-                    "error": item.get("error"),
-                    "approval_request_id": item.get("approval_request_id"),
-                    "status": item.get("status", "completed"),
-                    "execution_time": item.get("execution_time")
-                }
-                mcp_calls.append(mcp_call)
+            item_type = getattr(item, "type", None)
+            if item_type == "message":
+                message_count += 1
+            elif item_type != "reasoning" or getattr(item, "summary", None):
+                # 工具调用、图片生成或推理摘要需要走完整转换
+                return None
 
-                # 根据MCP调用状态设置finish_reason
-                if item.get("error"):
-                    finish_reason = "mcp_error"
-                elif item.get("approval_request_id"):
-                    finish_reason = "approval_required"
-                else:
-                    finish_reason = "mcp_tool_calls"
-
-            # 提取MCP审批请求
-            elif item.get("type") == "mcp_approval_request":
-                mcp_approval_request = {
-                    "id": item.get("id"),
-                    "type": "mcp_approval_request",
-                    "server_label": item.get("server_label"),
-                    "name": item.get("name"),
-                    "arguments": item.get("arguments")
-                }
-                mcp_approval_requests.append(mcp_approval_request)
-                finish_reason = "approval_required"
+        if message_count != 1:
+            return None
 
-            # 提取助手消息内容
-            elif item.get("type") == "message" and item.get("role") == "assistant":
-                message_content = item.get("content", [])
-
-                # 提取文本内容
-                for content_item in message_content:
-                    if content_item.get("type") == "output_text":
-                        assistant_content = content_item.get("text", "")
-                        break
-
-        # 构造选择对象
-        choice = {
-            "message": {
-                "role": "assistant",
-                "content": assistant_content
-            },
-            "finish_reason": finish_reason,
-            "index": 0
-        }
-
-        # 添加tool_calls如果有function calling
-        if function_calls:
-            choice["message"]["tool_calls"] = function_calls
-
-        # 添加custom tool calls如果有
-        if custom_tool_calls:
-            choice["message"]["custom_tool_calls"] = custom_tool_calls
-
-        # 如果有推理内容，添加到消息中
-        if reasoning_content:
-            choice["message"]["reasoning"] = reasoning_content
-
-        # 如果有图片生成结果，添加到消息中
-        if image_generations:
-            choice["message"]["image_generations"] = image_generations
-
-        # 如果有MCP工具列表，添加到消息中
-        if mcp_list_tools:
-            choice["message"]["mcp_list_tools"] = mcp_list_tools
-
-        # 如果有MCP调用结果，添加到消息中
-        if mcp_calls:
-            choice["message"]["mcp_calls"] = mcp_calls
-
-        # 如果有MCP审批请求，添加到消息中
-        if mcp_approval_requests:
-            choice["message"]["mcp_approval_requests"] = mcp_approval_requests
-
-        choices.append(choice)
-
-        # 如果没有任何内容但有图片生成结果，创建一个空消息来承载图片
-        if not choices and image_generations:
-            choice = {
-                "message": {
-                    "role": "assistant",
-                    "content": "",
-                    "image_generations": image_generations
-                },
+        usage = getattr(response, "usage", None)
+        return {
+            "id": response.id,
+            "choices": [{
+                "message": {"role": "assistant", "content": response.output_text},
                 "finish_reason": "stop",
                 "index": 0
-            }
-            choices.append(choice)
-
-        # 构造标准格式响应
-        converted_result = {
-            "id": responses_result.get("id", f"resp_{hash(str(output)) % 1000000}"),
-            "choices": choices,
-            "usage": responses_result.get("usage", {
+            }],
+            "usage": usage.model_dump(mode="json", exclude_unset=True, exclude_none=True) if usage else {
                 "prompt_tokens": 0,
                 "completion_tokens": 0,
                 "total_tokens": 0
-            })
+            }
         }
 
-        return converted_result
-
     async def _openai_responses_completion(
         self,
         model: str,
@@ -869,406 +1210,111 @@ class AIProviderService:
     ) -> Dict[str, Any]:
         """OpenAI Responses API 调用"""
         try:
+            if not self._HAS_RESPONSES_API:
+                # Responses API 不可用时抛出错误，不再回退
+                logger.error("Responses API 不可用，请升级 OpenAI SDK 到最新版本")
+                raise Exception("Responses API 不可用. 请运行: pip install --upgrade openai")
+
+            messages = _as_message_dicts(messages)
+
+            # 模型类型判断在下面多处使用，预先计算一次
+            is_gpt5 = self._is_gpt5_model(model)
+
             # 使用更长的超时时间，因为 Responses API 通常需要更多时间
-            timeout = self.responses_api_timeout if self._is_gpt5_model(model) or thinking_mode else self.default_timeout
-            client = openai.AsyncOpenAI(
-                api_key=api_key,
-                timeout=timeout
-            )
+            timeout = self.responses_api_timeout if is_gpt5 or thinking_mode else self.default_timeout
+            client = self._get_openai_client(api_key, timeout=timeout)
             
-            logger.info(f"调用OpenAI Responses API模型: {model}, 思考模式: {thinking_mode}")
+            logger.info("调用OpenAI Responses API模型: %s, 思考模式: %s", model, thinking_mode)
             
             # 对于 GPT-5 系列模型，使用 Responses API 支持 thinking mode
-            if self._is_gpt5_model(model) and thinking_mode:
-                # 检查是否有图片消息
-                has_images = any(
-                    (isinstance(msg, dict) and msg.get("images")) or
-                    (hasattr(msg, "images") and getattr(msg, "images", None))
-                    for msg in messages
-                )
-                
-                if has_images:
-                    # Responses API 支持图片，需要使用新的格式
-                    logger.info(f"检测到图片消息，使用Responses API的多模态输入格式")
-                    
-                    # 转换消息为 Responses API 格式
-                    input_messages = []
-                    instructions_text = ""
-                    
-                    for msg in messages:
-                        role = self._get_message_attr(msg, "role")
-                        content = self._get_message_attr(msg, "content")
-
-                        if role == "system":
-                            instructions_text = content
-                        elif role == "mcp_approval_response":
-                            # 处理MCP审批响应（特殊消息类型）
-                            if isinstance(msg, dict):
-                                input_messages.append({
-                                    "type": "mcp_approval_response",
-                                    "approve": msg.get("approve", True),
-                                    "approval_request_id": msg.get("approval_request_id")
-                                })
-                            else:
-                                # 对于Pydantic对象
-                                input_messages.append({
-                                    "type": "mcp_approval_response",
-                                    "approve": getattr(msg, "approve", True),
-                                    "approval_request_id": getattr(msg, "approval_request_id", "")
-                                })
-                        else:
-                            # 获取图片和文件数据
-                            images = None
-                            files = None
-                            if isinstance(msg, dict):
-                                images = msg.get("images")
-                                files = msg.get("files")
-                            else:
-                                images = getattr(msg, "images", None)
-                                files = getattr(msg, "files", None)
-                            
-                            # 构造内容部分数组
-                            content_parts = []
-                            
-                            # 添加文本内容
-                            if content and content.strip():
-                                content_parts.append({"type": "input_text", "text": content})
-                            
-                            # 添加图片内容
-                            if images and len(images) > 0:
-                                for image in images:
-                                    if isinstance(image, dict):
-                                        image_data = image.get("data")
-                                        mime_type = image.get("mime_type", "image/jpeg")
-                                    else:
-                                        image_data = getattr(image, "data", "")
-                                        mime_type = getattr(image, "mime_type", "image/jpeg")
-                                    
-                                    if image_data:
-                                        content_parts.append({
-                                            "type": "input_image",
-                                            "image_url": f"data:{mime_type};base64,{image_data}"
-                                        })
-                            
-                            # 添加文件内容（仅支持 direct 模式的 PDF 文件）
-                            if files and len(files) > 0:
-                                for file in files:
-                                    if isinstance(file, dict):
-                                        openai_file_id = file.get("openai_file_id")
-                                        process_mode = file.get("process_mode", "direct")
-                                    else:
-                                        openai_file_id = getattr(file, "openai_file_id", None)
-                                        process_mode = getattr(file, "process_mode", "direct")
-                                    
-                                    # 只有 direct 模式的文件才添加到 input_file（仅支持 PDF）
-                                    if openai_file_id and process_mode == "direct":
-                                        content_parts.append({
-                                            "type": "input_file",
-                                            "file_id": openai_file_id
-                                        })
-                            
-                            # 如果没有内容部分，添加空文本
-                            if not content_parts:
-                                content_parts.append({"type": "input_text", "text": ""})
-                            
-                            input_messages.append({
-                                "role": role,
-                                "content": content_parts
-                            })
-                    
-                    # 准备工具配置
-                    tools_config = self._prepare_tools_config(messages, tools)
-                    
-                    # 检查是否有图片生成工具并查找之前的图片生成结果
-                    previous_image_gen_id = ""
-                    has_image_gen_tool = tools and any(tool.get("type") == "image_generation" for tool in tools)
-                    if has_image_gen_tool:
-                        previous_image_gen_id = self._find_previous_image_generation(messages)
-
-                    # 使用 Responses API 的多模态参数结构
-                    # 将前端的 'instant' 映射为 OpenAI API 的 'minimal'
-                    # 但是当有图片生成工具时，'minimal' 不支持，需要升级到 'low'
-                    effort_value = self._map_reasoning_effort(model, reasoning, bool(has_image_gen_tool))
-                    completion_params = {
-                        "model": model,
-                        "input": input_messages,
-                        "reasoning": {
-                            "effort": effort_value,
-                            "summary": reasoning_summaries if reasoning_summaries != "auto" else "auto"
-                        }
-                    }
-                    
-                    # 如果有之前的图片生成结果，添加到请求中（用于多轮图像生成）
-                    if previous_image_gen_id:
-                        completion_params["previous_response_id"] = previous_image_gen_id
-                        logger.info(f"使用previous_response_id进行多轮图像生成: {previous_image_gen_id}")
-                    
-                    # 添加工具配置
-                    if tools_config["tools"]:
-                        completion_params.update(tools_config)
-                        # 如果有工具且是必需的，设置 tool_choice
-                        need_code_interpreter = any(tool.get("type") == "code_interpreter" for tool in tools_config["tools"])
-                        if need_code_interpreter:
-                            completion_params["tool_choice"] = "required"
-                    
-                    # 添加 instructions 如果有 system 消息
-                    if instructions_text:
-                        completion_params["instructions"] = instructions_text
-                    
-                    # GPT-5 系列模型使用 max_output_tokens
-                    completion_params["max_output_tokens"] = 4000
-                    
-                    # 打印实际发送的 JSON
-                    logger.info(f"📤 发送给 OpenAI Responses API 的完整请求: {json.dumps(completion_params, ensure_ascii=False, indent=2)}")
-                    
-                    response = await asyncio.wait_for(
-                        client.responses.create(**completion_params),
-                        timeout=timeout
-                    )
-                    
-                    result = response.model_dump()
-                    logger.info(f"OpenAI Responses API调用成功（多模态支持）")
-                    return self._convert_responses_to_chat_format(result)
-                
-                # 转换消息格式为 Responses API 所需的 input 格式
-                # 检查是否有文件，如果有则使用结构化输入格式
-                has_files = any(
-                    (isinstance(msg, dict) and msg.get("files")) or
-                    (hasattr(msg, "files") and getattr(msg, "files", None))
-                    for msg in messages
-                )
-                
+            if is_gpt5 and thinking_mode:
+                # 单次遍历：按纯文本模式拼接对话，同时检查是否有图片或文件；
+                # 一旦遇到图片或文件，改用结构化输入格式（由 _prepare_conversation 一次完成转换）
+                has_images = False
+                has_files = False
                 instructions_text = ""
-                
-                if has_files:
-                    # 使用结构化输入格式支持文件
-                    input_messages = []
-                    
-                    for msg in messages:
-                        role = self._get_message_attr(msg, "role")
-                        content = self._get_message_attr(msg, "content")
-                        
-                        if role == "system":
-                            instructions_text = content
-                        else:
-                            # 获取文件数据
-                            files = None
-                            if isinstance(msg, dict):
-                                files = msg.get("files")
-                            else:
-                                files = getattr(msg, "files", None)
-                            
-                            # 构造内容部分数组
-                            content_parts = []
-                            
-                            # 添加文本内容
-                            if content and content.strip():
-                                content_parts.append({"type": "input_text", "text": content})
-                            
-                            # 添加文件内容（仅支持 direct 模式的 PDF 文件）
-                            if files and len(files) > 0:
-                                for file in files:
-                                    if isinstance(file, dict):
-                                        openai_file_id = file.get("openai_file_id")
-                                        process_mode = file.get("process_mode", "direct")
-                                    else:
-                                        openai_file_id = getattr(file, "openai_file_id", None)
-                                        process_mode = getattr(file, "process_mode", "direct")
-                                    
-                                    # 只有 direct 模式的文件才添加到 input_file（仅支持 PDF）
-                                    if openai_file_id and process_mode == "direct":
-                                        content_parts.append({
-                                            "type": "input_file",
-                                            "file_id": openai_file_id
-                                        })
-                            
-                            # 如果没有内容部分，添加空文本
-                            if not content_parts:
-                                content_parts.append({"type": "input_text", "text": ""})
-                            
-                            input_messages.append({
-                                "role": role,
-                                "content": content_parts
-                            })
-                    
-                    # 准备工具配置
-                    tools_config = self._prepare_tools_config(messages, tools)
-                    
-                    # 检查是否有图片生成工具并查找之前的图片生成结果
-                    previous_image_gen_id = ""
-                    has_image_gen_tool = tools and any(tool.get("type") == "image_generation" for tool in tools)
-                    if has_image_gen_tool:
-                        previous_image_gen_id = self._find_previous_image_generation(messages)
-
-                    # 使用结构化输入格式
-                    # 将前端的 'instant' 映射为 OpenAI API 的 'minimal'
-                    # 但是当有图片生成工具时，'minimal' 不支持，需要升级到 'low'
-                    effort_value = self._map_reasoning_effort(model, reasoning, bool(has_image_gen_tool))
-                    completion_params = {
-                        "model": model,
-                        "input": input_messages,
-                        "reasoning": {
-                            "effort": effort_value,
-                            "summary": reasoning_summaries if reasoning_summaries != "auto" else "auto"
-                        }
-                    }
-                    
-                    # 如果有之前的图片生成结果，添加到请求中（用于多轮图像生成）
-                    if previous_image_gen_id:
-                        completion_params["previous_response_id"] = previous_image_gen_id
-                        logger.info(f"使用previous_response_id进行多轮图像生成: {previous_image_gen_id}")
-                    
-                    # 添加工具配置
-                    if tools_config["tools"]:
-                        completion_params.update(tools_config)
-                        # 如果有工具且是必需的，设置 tool_choice
-                        need_code_interpreter = any(tool.get("type") == "code_interpreter" for tool in tools_config["tools"])
-                        if need_code_interpreter:
-                            completion_params["tool_choice"] = "required"
-                    
-                else:
-                    # 纯文本模式（保持向后兼容）
-                    input_text = ""
-                    
-                    for msg in messages:
-                        role = self._get_message_attr(msg, "role")
-                        content = self._get_message_attr(msg, "content")
-                        
-                        if role == "system":
-                            instructions_text = content
-                        elif role == "user":
-                            input_text += f"{content}\n"
-                        elif role == "assistant":
-                            input_text += f"Assistant: {content}\n"
-                    
-                    # 检查是否有图片生成工具并查找之前的图片生成结果
-                    previous_image_gen_id = ""
-                    has_image_gen_tool = tools and any(tool.get("type") == "image_generation" for tool in tools)
-                    if has_image_gen_tool:
-                        previous_image_gen_id = self._find_previous_image_generation(messages)
-
-                    # 将前端的 'instant' 映射为 OpenAI API 的 'minimal'
-                    # 但是当有图片生成工具时，'minimal' 不支持，需要升级到 'low'
-                    effort_value = self._map_reasoning_effort(model, reasoning, bool(has_image_gen_tool))
-                    completion_params = {
-                        "model": model,
-                        "input": input_text.strip(),
-                        "reasoning": {
-                            "effort": effort_value,
-                            "summary": reasoning_summaries if reasoning_summaries != "auto" else "auto"
-                        }
-                    }
-                    
-                    # 如果有之前的图片生成结果，添加到请求中（用于多轮图像生成）
-                    if previous_image_gen_id:
-                        completion_params["previous_response_id"] = previous_image_gen_id
-                        logger.info(f"使用previous_response_id进行多轮图像生成: {previous_image_gen_id}")
-                
-                # 添加 instructions 如果有 system 消息
-                if instructions_text:
-                    completion_params["instructions"] = instructions_text
-                
-                # GPT-5 系列模型使用 max_output_tokens (不是 max_completion_tokens)
-                completion_params["max_output_tokens"] = 4000
-                
-                # 准备工具配置并添加到请求中
-                tools_config = self._prepare_tools_config(messages, tools, "openai")
-                if tools_config["tools"]:
-                    completion_params.update(tools_config)
-                
-                # 打印实际发送的 JSON
-                logger.info(f"📤 发送给 OpenAI Responses API 的完整请求: {json.dumps(completion_params, ensure_ascii=False, indent=2)}")
-                logger.info(f"使用 Responses API 参数格式{'（包含文件支持）' if has_files else '（纯文本模式）'}")
-                
-                # 调用 Responses API
-                try:
-                    response = await asyncio.wait_for(
-                        client.responses.create(**completion_params),
-                        timeout=timeout
-                    )
-                except AttributeError as e:
-                    # Responses API 不可用时抛出错误，不再回退
-                    logger.error("Responses API 不可用，请升级 OpenAI SDK 到最新版本")
-                    raise Exception(f"Responses API 不可用: {str(e)}. 请运行: pip install --upgrade openai")
-            else:
-                # ��׼�� Responses API ���ã�ͬʱ�̳�ͼƬ���ļ�����
-                input_messages = []
-                instructions_text = ""
-                uses_structured_content = False
+                input_lines = []
+                previous_image_gen_id = ""
 
                 for msg in messages:
-                    role = self._get_message_attr(msg, "role")
+                    if msg.get("images"):
+                        has_images = True
+                        break
+                    if msg.get("files"):
+                        has_files = True
+                        break
 
+                    role = msg.get("role", "")
+                    content = msg.get("content", "")
                     if role == "system":
-                        instructions_text = self._get_message_attr(msg, "content")
-                        continue
+                        instructions_text = content
+                    elif role == "user":
+                        input_lines.append(content)
+                    elif role == "assistant":
+                        input_lines.append(f"Assistant: {content}")
+                        # 记录最近一次图片生成结果（用于多轮图像生成）
+                        image_generations = msg.get("image_generations")
+                        if image_generations:
+                            previous_image_gen_id = image_generations[-1].get("id", "")
+
+                uses_structured_input = has_images or has_files
+                if uses_structured_input:
+                    logger.info("检测到%s消息，使用Responses API的结构化输入格式", "图片" if has_images else "文件")
+                    model_input, instructions_text, tools_config, previous_image_gen_id = self._prepare_conversation(messages, tools)
+                else:
+                    # 纯文本模式（保持向后兼容）；没有文件时工具配置与消息内容无关
+                    model_input = "\n".join(input_lines).strip()
+                    tools_config = self._build_openai_tools_config(False, set(), tools)
 
-                    if role == "mcp_approval_response":
-                        if isinstance(msg, dict):
-                            input_messages.append({
-                                "type": "mcp_approval_response",
-                                "approve": msg.get("approve", True),
-                                "approval_request_id": msg.get("approval_request_id")
-                            })
-                        else:
-                            input_messages.append({
-                                "type": "mcp_approval_response",
-                                "approve": getattr(msg, "approve", True),
-                                "approval_request_id": getattr(msg, "approval_request_id", "")
-                            })
-                        uses_structured_content = True
-                        continue
+                # 检查是否有图片生成工具，只有此时才使用之前的图片生成结果
+                has_image_gen_tool = self._find_tool(tools, "image_generation") is not None
+                if not has_image_gen_tool:
+                    previous_image_gen_id = ""
 
-                    converted_message, has_structured = self._convert_message_to_responses_input(msg)
-                    if has_structured:
-                        uses_structured_content = True
-                    input_messages.append(converted_message)
-
-                if uses_structured_content:
-                    normalized_messages: List[Dict[str, Any]] = []
-                    for item in input_messages:
-                        if isinstance(item, dict) and item.get("role"):
-                            content = item.get("content", "")
-                            if isinstance(content, list):
-                                if not content:
-                                    content = [{"type": "input_text", "text": ""}]
-                                item = {**item, "content": content}
-                            else:
-                                item = {
-                                    **item,
-                                    "content": [{"type": "input_text", "text": content or ""}]
-                                }
-                        normalized_messages.append(item)
-                    input_messages = normalized_messages
+                # 将前端的 'instant' 映射为 OpenAI API 的 'minimal'
+                # 但是当有图片生成工具时，'minimal' 不支持，需要升级到 'low'
+                effort_value = self._map_reasoning_effort(model, reasoning, has_image_gen_tool)
 
-                completion_params = {
-                    "model": model,
-                    "input": input_messages
-                }
+                # 如果有之前的图片生成结果，添加到请求中（用于多轮图像生成）
+                if previous_image_gen_id:
+                    logger.info("使用previous_response_id进行多轮图像生成: %s", previous_image_gen_id)
 
-                if instructions_text:
-                    completion_params["instructions"] = instructions_text
+                # 结构化输入中有 Code Interpreter 文件时，要求必须调用工具
+                completion_params = self._build_responses_params(
+                    model, model_input, instructions_text, tools_config["tools"],
+                    require_code_interpreter=uses_structured_input,
+                    reasoning={"effort": effort_value, "summary": reasoning_summaries},
+                    previous_response_id=previous_image_gen_id
+                )
+                
+                # 打印实际发送的 JSON（延迟到日志输出时才序列化）
+                logger.debug("📤 发送给 OpenAI Responses API 的完整请求: %s", _LazyJson(completion_params))
+                logger.info("使用 Responses API 参数格式%s", '（结构化输入）' if uses_structured_input else '（纯文本模式）')
+                
+                # 调用 Responses API
+                # 超时由客户端的 timeout 参数在 httpx 层处理，无需额外的 wait_for 任务
+                response = await client.responses.create(**completion_params)
+            else:
+                # ��׼�� Responses API ���ã�ͬʱ�̳�ͼƬ���ļ�����
+                input_messages, instructions_text, tools_config, _ = self._prepare_conversation(messages, tools)
 
-                tools_config = self._prepare_tools_config(messages, tools, "openai")
-                if tools_config["tools"]:
-                    completion_params["tools"] = tools_config["tools"]
-                    need_code_interpreter = any(tool.get("type") == "code_interpreter" for tool in tools_config["tools"])
-                    if need_code_interpreter:
-                        completion_params["tool_choice"] = "required"
+                completion_params = self._build_responses_params(
+                    model, input_messages, instructions_text, tools_config["tools"],
+                    require_code_interpreter=True,
+                    temperature=None if is_gpt5 else 0.7
+                )
 
-                if not self._is_gpt5_model(model):
-                    completion_params["temperature"] = 0.7
+                response = await client.responses.create(**completion_params)
+            
 
-                completion_params["max_output_tokens"] = 4000
+            logger.info("OpenAI Responses API调用成功")
 
-                response = await asyncio.wait_for(
-                    client.responses.create(**completion_params),
-                    timeout=timeout
-                )
-            
+            # 纯文本回复直接构造结果，跳过完整的 model_dump 和格式转换
+            fast_result = self._convert_text_only_response(response)
+            if fast_result is not None:
+                return fast_result
 
-            result = response.model_dump()
-            logger.info(f"OpenAI Responses API调用成功")
+            result = response.model_dump(mode="json", exclude_unset=True, exclude_none=True)
             
             # 转换 Responses API 格式为标准 Chat Completions 格式
             converted_result = self._convert_responses_to_chat_format(result)
@@ -1276,29 +1322,80 @@ class AIProviderService:
             
         except Exception as e:
             logger.error(f"OpenAI Responses API调用失败: {str(e)}")
-            raise Exception(f"OpenAI Responses API调用失败: {str(e)}")
+            raise Exception(f"OpenAI Responses API调用失败: {str(e)}") from e
+
+    def _build_responses_params(
+        self,
+        model: str,
+        model_input: Union[str, List[Dict[str, Any]]],
+        instructions_text: str,
+        tools: List[Dict[str, Any]],
+        require_code_interpreter: bool = False,
+        reasoning: Dict[str, str] = None,
+        previous_response_id: str = "",
+        temperature: float = None
+    ) -> Dict[str, Any]:
+        """构建 Responses API 请求参数（普通、思考和流式调用共用）
+
+        require_code_interpreter 为 True 且工具中包含 Code Interpreter 时，要求模型必须调用工具。
+        """
+        params = {"model": model, "input": model_input}
+
+        if reasoning:
+            params["reasoning"] = reasoning
+        if previous_response_id:
+            params["previous_response_id"] = previous_response_id
+        if instructions_text:
+            params["instructions"] = instructions_text
+
+        if tools:
+            params["tools"] = tools
+            if require_code_interpreter and any(tool.get("type") == "code_interpreter" for tool in tools):
+                params["tool_choice"] = "required"
+
+        if temperature is not None:
+            params["temperature"] = temperature
+
+        # Responses API 使用 max_output_tokens (不是 max_completion_tokens)
+        params["max_output_tokens"] = 4000
+
+        # 相同的 instructions + 工具前缀使用同一个缓存键，使请求路由到已缓存该前缀的后端
+        params["prompt_cache_key"] = self._prompt_cache_key(model, instructions_text, tools)
+        return params
+
+    @staticmethod
+    def _prompt_cache_key(model: str, instructions_text: str, tools: Optional[List[Dict[str, Any]]]) -> str:
+        """按模型、instructions 和工具定义（键排序后序列化）计算稳定的提示缓存键"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model.encode())
+        digest.update(b"\0")
+        digest.update((instructions_text or "").encode())
+        digest.update(b"\0")
+        digest.update(orjson.dumps(tools or [], option=orjson.OPT_SORT_KEYS, default=str))
+        return digest.hexdigest()
+
+    def _split_anthropic_messages(self, messages: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+        """拆出 system 消息并把其余消息转换为 Anthropic 格式，返回 (system_message, user_messages)
+
+        多条 system 消息时以最后一条为准。
+        """
+        convert = self._convert_message_to_anthropic_format
+        system_message = next(
+            (msg.get("content") or "" for msg in reversed(messages) if msg.get("role") == "system"), ""
+        )
+        user_messages = [convert(msg) for msg in messages if msg.get("role") != "system"]
+        return system_message, user_messages
 
     def _convert_message_to_anthropic_format(self, msg: Union[Dict[str, Any], Any]) -> Dict[str, Any]:
         """将消息转换为Anthropic Messages API格式，支持图片、文件、搜索结果和引用"""
-        role = self._get_message_attr(msg, "role")
-        content = self._get_message_attr(msg, "content")
+        role, content = self._message_parts(msg)
         
         # 获取多媒体和附加数据
-        images = None
-        files = None
-        search_results = None
-        citations_enabled = True  # 默认启用引用（符合 Anthropic 文档建议）
-
-        if isinstance(msg, dict):
-            images = msg.get("images")
-            files = msg.get("files")
-            search_results = msg.get("search_results")
-            citations_enabled = msg.get("citations_enabled", True)  # 默认为 True
-        else:
-            images = getattr(msg, "images", None)
-            files = getattr(msg, "files", None)
-            search_results = getattr(msg, "search_results", None)
-            citations_enabled = getattr(msg, "citations_enabled", True)  # 默认为 True
+        view = _msg_view(msg)
+        images = view.get("images")
+        files = view.get("files")
+        search_results = view.get("search_results")
+        citations_enabled = view.get("citations_enabled", True)  # 默认启用引用（符合 Anthropic 文档建议）
         
         # 检查是否有多媒体内容
         has_multimedia = (images and len(images) > 0) or (files and len(files) > 0) or (search_results and len(search_results) > 0)
@@ -1309,23 +1406,21 @@ class AIProviderService:
         
         # 构造支持多媒体的消息格式
         content_parts = []
+        append = content_parts.append
         
         # 添加文本内容（如果有）
-        if content and content.strip():
-            content_parts.append({"type": "text", "text": content})
+        if content and not content.isspace():
+            append({"type": "text", "text": content})
         
         # 添加图片内容（Vision支持）
         if images:
             for image in images:
-                if isinstance(image, dict):
-                    image_data = image.get("data")
-                    mime_type = image.get("mime_type", "image/jpeg")
-                else:
-                    image_data = getattr(image, "data", "")
-                    mime_type = getattr(image, "mime_type", "image/jpeg")
+                image = _msg_view(image)
+                image_data = image.get("data")
+                mime_type = image.get("mime_type", "image/jpeg")
                 
                 if image_data:
-                    content_parts.append({
+                    append({
                         "type": "image",
                         "source": {
                             "type": "base64",
@@ -1337,128 +1432,47 @@ class AIProviderService:
         # 添加文件内容（根据类型分流为image或document）
         if files:
             for file in files:
-                if isinstance(file, dict):
-                    file_id = file.get("anthropic_file_id")
-                    filename = file.get("filename")
-                    file_data = file.get("data")  # base64数据
-                    mime_type = file.get("mime_type", "application/octet-stream")
-                    file_url = file.get("url")  # URL方式
-                else:
-                    file_id = getattr(file, "anthropic_file_id", "")
-                    filename = getattr(file, "filename", "")
-                    file_data = getattr(file, "data", "")
-                    mime_type = getattr(file, "mime_type", "application/octet-stream")
-                    file_url = getattr(file, "url", "")
+                file = _msg_view(file)
+                file_id = file.get("anthropic_file_id")
+                filename = file.get("filename")
+                file_data = file.get("data")  # base64数据
+                mime_type = file.get("mime_type", "application/octet-stream")
+                file_url = file.get("url")  # URL方式
                 
-                # 根据MIME类型判断是图片还是文档
-                if mime_type.startswith("image/"):
-                    # 图片文件：作为image content处理（Vision支持）
-                    if file_id:
-                        # 使用Files API上传的图片
-                        content_parts.append({
-                            "type": "image",
-                            "source": {
-                                "type": "file",
-                                "file_id": file_id
-                            }
-                        })
-                    elif file_url:
-                        # URL方式的图片
-                        content_parts.append({
-                            "type": "image",
-                            "source": {
-                                "type": "url",
-                                "url": file_url
-                            }
-                        })
-                    elif file_data:
-                        # Base64方式的图片
-                        content_parts.append({
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": mime_type,
-                                "data": file_data
-                            }
-                        })
+                # 根据MIME类型只判断一次：图片作为image，其余作为document
+                is_image = mime_type.startswith("image/")
+                block_type = "image" if is_image else "document"
+
+                if file_id:
+                    # 使用Files API上传的文件
+                    source = {"type": "file", "file_id": file_id}
+                elif file_url:
+                    # URL方式的文件
+                    source = {"type": "url", "url": file_url}
+                elif file_data and (
+                    is_image
+                    or mime_type == "application/pdf"
+                    or mime_type.startswith("text/")
+                    or mime_type in self._ANTHROPIC_TEXT_DOCUMENT_MIMES
+                ):
+                    # Base64方式的图片、PDF 或文本类文档（文本无需在本地解码）
+                    source = {"type": "base64", "media_type": mime_type, "data": file_data}
                 else:
-                    # 非图片文件：作为document content处理（PDF、文档等）
-                    if file_id:
-                        # 使用Files API上传的文档
-                        content_parts.append({
-                            "type": "document",
-                            "source": {
-                                "type": "file",
-                                "file_id": file_id
-                            }
-                        })
-                    elif file_url:
-                        # URL方式的文档
-                        content_parts.append({
-                            "type": "document",
-                            "source": {
-                                "type": "url",
-                                "url": file_url
-                            }
-                        })
-                    elif file_data and mime_type == "application/pdf":
-                        # Base64方式的PDF文档
-                        content_parts.append({
-                            "type": "document",
-                            "source": {
-                                "type": "base64",
-                                "media_type": mime_type,
-                                "data": file_data
-                            }
-                        })
-                    elif file_data and (mime_type.startswith("text/") or mime_type in ["application/json", "application/xml"]):
-                        # 文本类文档（需要解码base64为文本）
-                        try:
-                            import base64
-                            if file_data.strip():  # 检查是否为base64
-                                try:
-                                    text_content = base64.b64decode(file_data).decode('utf-8')
-                                except:
-                                    text_content = file_data  # 假设已经是文本
-                            else:
-                                text_content = file_data
-                            
-                            content_parts.append({
-                                "type": "document",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": mime_type,
-                                    "data": file_data
-                                }
-                            })
-                        except Exception as e:
-                            # 如果解码失败，仍然按原始数据处理
-                            content_parts.append({
-                                "type": "document", 
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": mime_type,
-                                    "data": file_data
-                                }
-                            })
+                    continue
+
+                append({"type": block_type, "source": source})
         
         # 添加搜索结果内容（Search Results支持）
         if search_results:
             for result in search_results:
-                if isinstance(result, dict):
-                    source = result.get("source", "")
-                    title = result.get("title", "")
-                    result_content = result.get("content", "")
-                else:
-                    source = getattr(result, "source", "")
-                    title = getattr(result, "title", "")
-                    result_content = getattr(result, "content", "")
+                result = _msg_view(result)
+                result_content = result.get("content")
                 
                 if result_content:
-                    content_parts.append({
+                    append({
                         "type": "search_result",
-                        "source": source,
-                        "title": title,
+                        "source": result.get("source") or "",
+                        "title": result.get("title") or "",
                         "content": [
                             {
                                 "type": "text",
@@ -1474,23 +1488,15 @@ class AIProviderService:
         }
 
     def _check_uses_files_api(self, messages: List[Dict[str, Any]]) -> bool:
-        """检查消息中是否使用了Files API"""
-        for message in messages:
-            content = message.get("content", [])
-            if isinstance(content, list):
-                for content_block in content:
-                    if isinstance(content_block, dict):
-                        # 检查image content blocks
-                        if content_block.get("type") == "image":
-                            source = content_block.get("source", {})
-                            if source.get("type") == "file":
-                                return True
-                        # 检查document content blocks
-                        elif content_block.get("type") == "document":
-                            source = content_block.get("source", {})
-                            if source.get("type") == "file":
-                                return True
-        return False
+        """检查消息中是否使用了Files API（image/document 内容块的 source 为 file）"""
+        block_types = self._FILES_API_BLOCK_TYPES
+        return any(
+            content_block.get("source", {}).get("type") == "file"
+            for message in messages
+            if isinstance(content := message.get("content"), list)
+            for content_block in content
+            if isinstance(content_block, dict) and content_block.get("type") in block_types
+        )
 
     async def _anthropic_completion(
         self,
@@ -1500,30 +1506,16 @@ class AIProviderService:
         thinking_mode: bool = False,
         tools: List[Dict[str, Any]] = None,
         stream: bool = False
-    ) -> Dict[str, Any]:
-        """Anthropic Claude Messages API 调用，支持Extended Thinking、Vision、Files、Citations和Search Results"""
-        try:
-            client = anthropic.AsyncAnthropic(
-                api_key=api_key,
-                timeout=self.default_timeout
-            )
-            
-            logger.info(f"调用Anthropic模型: {model}, 扩展思考模式: {thinking_mode}, 流式输出: {stream}")
+    ) -> Dict[str, Any]:
+        """Anthropic Claude Messages API 调用，支持Extended Thinking、Vision、Files、Citations和Search Results"""
+        try:
+            client = self._get_anthropic_client(api_key)
+            messages = _as_message_dicts(messages)
             
-            system_message = ""
-            user_messages = []
+            logger.info("调用Anthropic模型: %s, 扩展思考模式: %s, 流式输出: %s", model, thinking_mode, stream)
             
             # 转换消息格式以支持多媒体内容
-            for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
-                
-                if role == "system":
-                    system_message = content
-                else:
-                    # 转换为Anthropic Messages API格式
-                    converted_msg = self._convert_message_to_anthropic_format(msg)
-                    user_messages.append(converted_msg)
+            system_message, user_messages = self._split_anthropic_messages(messages)
             
             # Extended Thinking支持 - 需要先确定是否启用思考模式
             thinking_budget_tokens = 10000 if thinking_mode else 0
@@ -1533,8 +1525,7 @@ class AIProviderService:
                 "model": model,
                 "max_tokens": 16384 if thinking_mode else 4000,  # 思考模式需要更大的max_tokens
                 "messages": user_messages,
-                "temperature": 1 if thinking_mode else 0.7,  # 思考模式下必须为1
-                "stream": stream
+                "temperature": 1 if thinking_mode else 0.7  # 思考模式下必须为1
             }
 
             # 添加system消息（如果有）
@@ -1547,7 +1538,7 @@ class AIProviderService:
                     "type": "enabled",
                     "budget_tokens": thinking_budget_tokens
                 }
-                logger.info(f"启用Claude扩展思考模式，budget_tokens: {thinking_budget_tokens}, max_tokens: {kwargs['max_tokens']}, temperature: 1")
+                logger.info("启用Claude扩展思考模式，budget_tokens: %s, max_tokens: %s, temperature: 1", thinking_budget_tokens, kwargs['max_tokens'])
             
             # 工具配置（如果有）
             if tools:
@@ -1578,44 +1569,101 @@ class AIProviderService:
             if uses_files_api:
                 kwargs["betas"] = ["files-api-2025-04-14"]
                 logger.info("检测到Files API使用，已添加betas参数")
+
+            # 固定 system 和工具定义的序列化顺序并打上缓存断点，使多轮对话的请求前缀可以命中提示缓存
+            self._apply_anthropic_prompt_cache(kwargs)
             
             # 调用Anthropic Messages API
-            if uses_files_api:
-                response = await asyncio.wait_for(
-                    client.beta.messages.create(**kwargs),
-                    timeout=self.default_timeout
-                )
+            messages_api = client.beta.messages if uses_files_api else client.messages
+            if stream:
+                # 通过流式接口逐块接收，再聚合为完整消息（长响应无需等待单次阻塞请求）
+                # 超时由客户端的 timeout 参数按连接/读取间隔处理（SSE ping 也会重置读取计时），
+                # 持续输出或等待服务端工具调用的长响应不会被整体截断
+                async with messages_api.stream(**kwargs) as message_stream:
+                    response = await message_stream.get_final_message()
             else:
-                response = await asyncio.wait_for(
-                    client.messages.create(**kwargs),
-                    timeout=self.default_timeout
-                )
+                response = await messages_api.create(**kwargs)
             
             # 转换响应为OpenAI兼容格式
             result = self._convert_anthropic_response_to_openai_format(response, thinking_mode)
             
-            logger.info(f"Anthropic API调用成功，响应内容块数量: {len(response.content) if hasattr(response, 'content') else 0}")
+            logger.info("Anthropic API调用成功，响应内容块数量: %s", len(getattr(response, 'content', None) or ()))
             return result
             
         except anthropic.AuthenticationError as e:
             logger.error(f"Anthropic认证失败: {str(e)}")
-            raise Exception("Anthropic API密钥无效，请检查您的API密钥")
+            raise Exception("Anthropic API密钥无效，请检查您的API密钥") from e
         except anthropic.RateLimitError as e:
             logger.error(f"Anthropic速率限制: {str(e)}")
-            raise Exception("Anthropic API请求频率过高，请稍后重试")
+            raise Exception("Anthropic API请求频率过高，请稍后重试") from e
         except Exception as e:
             logger.error(f"Anthropic API调用失败: {str(e)}")
-            raise Exception(f"Anthropic API调用失败: {str(e)}")
+            raise Exception(f"Anthropic API调用失败: {str(e)}") from e
+
+    @staticmethod
+    def _apply_anthropic_prompt_cache(kwargs: Dict[str, Any]) -> None:
+        """为 system、工具定义和最后一条消息添加 cache_control 断点
+
+        提示缓存要求前缀逐字节一致：工具列表本身按确定的顺序构建，这里只浅拷贝最后一个工具来加断点
+        （不修改缓存的工具转换结果，也不改变 input_schema 中属性的顺序），
+        断点打在 system 文本块和最后一个工具上，工具 + system 作为一个整体被缓存；
+        最后一条消息的最后一个内容块也打上断点，下一轮对话可以复用到此为止的整段历史。
+        """
+        tools = kwargs.get("tools")
+        if tools:
+            kwargs["tools"] = [*tools[:-1], {**tools[-1], "cache_control": {"type": "ephemeral"}}]
+
+        system = kwargs.get("system")
+        if isinstance(system, str):
+            kwargs["system"] = [{
+                "type": "text",
+                "text": system,
+                "cache_control": {"type": "ephemeral"}
+            }]
+
+        # 转换后的消息可能复用调用方的字典，只替换列表中的元素而不原地修改
+        messages = kwargs.get("messages")
+        if messages:
+            last_message = messages[-1]
+            content = last_message.get("content")
+            if isinstance(content, str):
+                # 空文本块不能设置 cache_control
+                if not content:
+                    return
+                blocks = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            elif isinstance(content, list) and content:
+                blocks = [*content[:-1], {**content[-1], "cache_control": {"type": "ephemeral"}}]
+            else:
+                return
+            messages[-1] = {**last_message, "content": blocks}
 
     def _convert_tools_to_anthropic_format(self, tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """将工具配置转换为Anthropic格式"""
+        """将工具配置转换为Anthropic格式
+
+        同一会话中每轮请求的工具配置通常相同，转换结果按工具配置的序列化内容缓存。
+        """
+        try:
+            tools_key = orjson.dumps(tools, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            return self._build_anthropic_tools(tools)
+        # 返回新列表，调用方追加工具时不会改动缓存
+        return list(self._cached_anthropic_tools(tools_key))
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _cached_anthropic_tools(tools_key: bytes) -> Tuple[Dict[str, Any], ...]:
+        """按序列化后的工具配置缓存 Anthropic 工具转换结果"""
+        return tuple(AIProviderService._build_anthropic_tools(orjson.loads(tools_key)))
+
+    @staticmethod
+    def _build_anthropic_tools(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """实际执行工具配置到Anthropic格式的转换"""
         anthropic_tools = []
 
-        logger.info(f"转换工具到Anthropic格式，输入工具: {tools}")
+        logger.debug("转换工具到Anthropic格式，输入工具: %s", tools)
 
         for tool in tools:
             tool_type = tool.get("type")
-            logger.info(f"处理工具类型: {tool_type}")
 
             if tool_type == "web_search" or tool_type == "web_search_20250305":
                 # Web Search工具 - 支持Anthropic web_search_20250305格式
@@ -1638,132 +1686,49 @@ class AIProviderService:
                     anthropic_tool["blocked_domains"] = tool.get("blocked_domains")
 
                 anthropic_tools.append(anthropic_tool)
-                logger.info(f"已添加 web_search 工具到 Anthropic 配置: {anthropic_tool}")
 
             # 可以在这里添加其他工具类型的支持
 
-        logger.info(f"转换后的Anthropic工具列表: {anthropic_tools}")
+        logger.debug("转换后的Anthropic工具列表: %s", anthropic_tools)
         return anthropic_tools
 
     def _convert_anthropic_response_to_openai_format(self, response: Any, thinking_mode: bool = False) -> Dict[str, Any]:
         """将Anthropic响应转换为OpenAI兼容格式"""
-        content_text = ""
-        thinking_content = ""
-        citations = []
-        tool_calls = []
-        mcp_tool_uses = []
-        mcp_tool_results = []
-
-        # 处理响应内容
-        if hasattr(response, 'content') and response.content:
-            for content_block in response.content:
-                if hasattr(content_block, 'type'):
-                    if content_block.type == "text":
-                        # 文本内容
-                        content_text += getattr(content_block, 'text', '')
-
-                        # 提取citations（如果有）
-                        if hasattr(content_block, 'citations') and content_block.citations:
-                            for citation in content_block.citations:
-                                citations.append({
-                                    "type": getattr(citation, 'type', 'unknown'),
-                                    "cited_text": getattr(citation, 'cited_text', ''),
-                                    "source": getattr(citation, 'source', ''),
-                                    "title": getattr(citation, 'title', ''),
-                                    "document_index": getattr(citation, 'document_index', 0),
-                                    "start_char_index": getattr(citation, 'start_char_index', 0),
-                                    "end_char_index": getattr(citation, 'end_char_index', 0)
-                                })
-
-                    elif content_block.type == "thinking" and thinking_mode:
-                        # 扩展思考内容
-                        thinking_content = getattr(content_block, 'content', '') or getattr(content_block, 'thinking', '')
-
-                    elif content_block.type == "tool_use":
-                        # 标准function calling工具使用
-                        tool_call = {
-                            "id": getattr(content_block, 'id', ''),
-                            "type": "function",
-                            "function": {
-                                "name": getattr(content_block, 'name', ''),
-                                "arguments": json.dumps(getattr(content_block, 'input', {}))
-                            }
-                        }
-                        tool_calls.append(tool_call)
-
-                    elif content_block.type == "mcp_tool_use":
-                        # MCP工具使用
-                        mcp_tool_use = {
-                            "id": getattr(content_block, 'id', ''),
-                            "type": "mcp_tool_use",
-                            "name": getattr(content_block, 'name', ''),
-                            "server_name": getattr(content_block, 'server_name', ''),
-                            "input": getattr(content_block, 'input', {})
-                        }
-                        mcp_tool_uses.append(mcp_tool_use)
-
-                    elif content_block.type == "mcp_tool_result":
-                        # MCP工具结果
-                        mcp_tool_result = {
-                            "tool_use_id": getattr(content_block, 'tool_use_id', ''),
-                            "type": "mcp_tool_result",
-                            "is_error": getattr(content_block, 'is_error', False),
-                            "content": getattr(content_block, 'content', []),
-                            "server_name": getattr(content_block, 'server_name', ''),
-                            "execution_time": getattr(content_block, 'execution_time', None)
-                        }
-                        mcp_tool_results.append(mcp_tool_result)
-        
-        # 构建消息对象
-        message = {
-            "role": "assistant",
-            "content": content_text
-        }
-        
-        # 添加思考内容（如果有）
-        if thinking_content and thinking_mode:
-            message["reasoning"] = thinking_content
-        
-        # 添加citations（如果有）
-        if citations:
-            message["citations"] = citations
-
-        # 添加标准function calling工具调用（如果有）
-        if tool_calls:
-            message["tool_calls"] = tool_calls
-
-        # 添加MCP工具使用和结果（如果有）
-        if mcp_tool_uses:
-            message["mcp_tool_uses"] = mcp_tool_uses
-
-        if mcp_tool_results:
-            message["mcp_tool_results"] = mcp_tool_results
+        # 按内容块类型查表分发，每个块只做一次类型查找
+        message = anthropic_blocks_to_message(getattr(response, 'content', None) or (), thinking_mode)
 
         # 构建完整响应
-        result = {
-            "id": f"msg_{getattr(response, 'id', 'unknown')}",
-            "choices": [{
-                "message": message,
-                "finish_reason": self._map_anthropic_stop_reason(getattr(response, 'stop_reason', None))
-            }],
+        usage = getattr(response, 'usage', None)
+        return self._build_chat_format(
+            "msg_" + str(getattr(response, 'id', 'unknown')),
+            message,
+            self._map_anthropic_stop_reason(getattr(response, 'stop_reason', None)),
+            getattr(usage, 'input_tokens', 0) or 0,
+            getattr(usage, 'output_tokens', 0) or 0
+        )
+
+    @staticmethod
+    def _build_chat_format(
+        response_id: str,
+        message: Dict[str, Any],
+        finish_reason: str,
+        input_tokens: int,
+        output_tokens: int
+    ) -> Dict[str, Any]:
+        """一次性构造 Chat Completions 格式的响应字典"""
+        return {
+            "id": response_id,
+            "choices": [{"message": message, "finish_reason": finish_reason}],
             "usage": {
-                "prompt_tokens": getattr(response.usage, 'input_tokens', 0) if hasattr(response, 'usage') else 0,
-                "completion_tokens": getattr(response.usage, 'output_tokens', 0) if hasattr(response, 'usage') else 0,
-                "total_tokens": (getattr(response.usage, 'input_tokens', 0) + getattr(response.usage, 'output_tokens', 0)) if hasattr(response, 'usage') else 0
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens
             }
         }
-        
-        return result
 
     def _map_anthropic_stop_reason(self, stop_reason: str) -> str:
         """映射Anthropic的停止原因到OpenAI格式"""
-        mapping = {
-            "end_turn": "stop",
-            "max_tokens": "length",
-            "tool_use": "tool_calls",
-            "mcp_tool_use": "mcp_tool_calls"
-        }
-        return mapping.get(stop_reason, "stop")
+        return self._ANTHROPIC_STOP_REASONS.get(stop_reason, "stop")
 
     async def _google_completion(
         self,
@@ -1780,34 +1745,13 @@ class AIProviderService:
         """Google Gemini API 调用 - 完整实现"""
         try:
             # 创建客户端实例（新版 SDK）
-            client = genai.Client(api_key=api_key)
-
-            logger.info(f"调用Google模型: {model}, 流式: {stream}")
+            client = self._get_genai_client(api_key)
 
-            # 转换消息格式和多模态内容
-            contents = []
-            system_instruction = None
+            logger.info("调用Google模型: %s, 流式: %s", model, stream)
 
-            # 处理系统消息
-            for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
-
-                if role == "system":
-                    system_instruction = content
-                    continue
-                elif role == "user":
-                    # 处理多模态内容
-                    parts = self._convert_message_to_gemini_parts(msg)
-                    contents.append({
-                        "role": "user",
-                        "parts": parts
-                    })
-                elif role == "assistant":
-                    contents.append({
-                        "role": "model",
-                        "parts": [{"text": content}]
-                    })
+            # 转换消息格式和多模态内容（Pydantic 消息先一次性转为字典，之后统一按字典读取）
+            messages = _as_message_dicts(messages)
+            contents, system_instruction = await self._build_gemini_contents_async(messages)
 
             # 配置生成参数
             config_dict = {
@@ -1838,13 +1782,16 @@ class AIProviderService:
 
             generation_config = types.GenerateContentConfig(**config_dict)
 
-            # 处理最后一条用户消息
+            # 处理最后一条消息（用户消息直接复用已转换的 parts）
             last_message = messages[-1]
-            user_parts = self._convert_message_to_gemini_parts(last_message)
+            if contents and last_message.get("role") == "user":
+                user_parts = contents[-1]["parts"]
+            else:
+                user_parts = self._convert_message_to_gemini_parts(last_message)
 
             # 检查是否有图像生成工具
             if tools:
-                image_gen_tool = next((t for t in tools if t.get("type") == "image_generation"), None)
+                image_gen_tool = self._find_tool(tools, "image_generation")
                 if image_gen_tool:
                     # 提取提示文本
                     prompt_text = self._extract_text_from_parts(user_parts)
@@ -1863,14 +1810,14 @@ class AIProviderService:
                         # 如果 Imagen API 不可用，回退到 Gemini 图片模型
                         logger.warning("Imagen API 不可用，使用 Gemini 图片模型作为备用方案")
                         return await self._handle_google_image_generation(
-                            user_parts, api_key, tools, model
+                            user_parts, api_key, image_gen_tool, model
                         )
                     except Exception as e:
                         # 如果 Imagen API 失败，尝试备用方案
                         logger.warning(f"Imagen API 调用失败: {e}，尝试使用 Gemini 图片模型")
                         try:
                             return await self._handle_google_image_generation(
-                                user_parts, api_key, tools, model
+                                user_parts, api_key, image_gen_tool, model
                             )
                         except Exception as e2:
                             logger.error(f"Gemini 图片模型也失败: {e2}")
@@ -1885,65 +1832,91 @@ class AIProviderService:
 
             # 生成响应（使用新版 SDK API）
             if stream:
-                return await self._google_stream_completion(
-                    client, model, contents, generation_config, gemini_tools
+                # 逐块接收流式增量并聚合为完整响应
+                return await self._collect_google_stream(
+                    self._google_stream_completion(client, model, contents, generation_config), model
                 )
             else:
-                response = await asyncio.wait_for(
-                    client.aio.models.generate_content(
+                # asyncio.timeout 直接在当前任务上设置截止时间，不像 wait_for 那样额外创建任务
+                async with asyncio.timeout(self.default_timeout):
+                    response = await client.aio.models.generate_content(
                         model=model,
                         contents=contents,
                         config=generation_config
-                    ),
-                    timeout=self.default_timeout
-                )
+                    )
 
                 return self._convert_gemini_response_to_openai_format(response, model)
 
         except Exception as e:
             logger.error(f"Google API调用失败: {str(e)}")
-            raise Exception(f"Google API调用失败: {str(e)}")
+            raise Exception(f"Google API调用失败: {str(e)}") from e
+
+    def _build_gemini_contents(self, messages: List[Union[Dict[str, Any], Any]]) -> Tuple[List[Dict[str, Any]], Any]:
+        """将消息列表转换为Gemini contents，返回 (contents, system_instruction)"""
+        role_map = self._GEMINI_ROLE_MAP
+        system_instruction = None
+        contents = []
+
+        for msg in messages:
+            role, content = self._message_parts(msg)
+            if role == "system":
+                system_instruction = content
+                continue
+
+            gemini_role = role_map.get(role)
+            if gemini_role is None:
+                continue
+
+            # 用户消息处理多模态内容，助手消息只保留文本
+            parts = self._convert_message_to_gemini_parts(msg) if role == "user" else [{"text": content}]
+            contents.append({"role": gemini_role, "parts": parts})
+
+        return contents, system_instruction
+
+    async def _build_gemini_contents_async(
+        self,
+        messages: List[Dict[str, Any]]
+    ) -> Tuple[List[Dict[str, Any]], Any]:
+        """带图片的消息在线程池中转换（base64 解码不阻塞事件循环），纯文本消息直接在当前线程转换"""
+        if any(msg.get("images") for msg in messages):
+            return await asyncio.to_thread(self._build_gemini_contents, messages)
+        return self._build_gemini_contents(messages)
 
     def _convert_message_to_gemini_parts(self, msg):
         """将消息转换为Gemini Parts格式，支持多模态（新版 SDK）"""
-        content = self._get_message_attr(msg, "content")
-
-        # 获取图片数据
-        images = None
-        if isinstance(msg, dict):
-            images = msg.get("images")
-        else:
-            images = getattr(msg, "images", None)
+        view = _msg_view(msg)
+        content = view.get("content")
+        images = view.get("images")
 
         parts = []
+        append = parts.append
 
         # 添加文本内容（新版 SDK 使用字典格式）
-        if content and content.strip():
-            parts.append({"text": content})
+        if content and not content.isspace():
+            append({"text": content})
 
         # 添加图片内容
         if images:
+            b64decode = base64.b64decode
             for image in images:
-                if isinstance(image, dict):
-                    image_data = image.get("data")
-                    mime_type = image.get("mime_type", "image/jpeg")
-                else:
-                    image_data = getattr(image, "data", "")
-                    mime_type = getattr(image, "mime_type", "image/jpeg")
+                image = _msg_view(image)
+                image_data = image.get("data")
+                if not image_data:
+                    continue
 
-                if image_data:
-                    import base64
-                    try:
-                        # 解码base64图片数据
-                        image_bytes = base64.b64decode(image_data)
-                        parts.append({
-                            "inline_data": {
-                                "mime_type": mime_type,
-                                "data": image_bytes
-                            }
-                        })
-                    except Exception as e:
-                        logger.warning(f"解码图片数据失败: {e}")
+                try:
+                    # 解码base64图片数据（binascii.Error 是 ValueError 的子类）
+                    image_bytes = b64decode(image_data)
+                except ValueError as e:
+                    logger.warning("解码图片数据失败: %s", e)
+                    continue
+
+                append({
+                    "inline_data": {
+                        "mime_type": image.get("mime_type", "image/jpeg"),
+                        "data": image_bytes
+                    }
+                })
 
         return parts if parts else [{"text": content or ""}]
 
@@ -2083,49 +2056,118 @@ class AIProviderService:
 
     def _get_thinking_budget(self, reasoning):
         """根据reasoning级别获取thinking budget"""
-        budget_map = {
-            "low": 1000,
-            "medium": 5000,
-            "high": 10000
-        }
-        return budget_map.get(reasoning, 5000)
+        return self._THINKING_BUDGETS.get(reasoning, 5000)
 
-    async def _google_stream_completion(self, client, model, contents, generation_config, gemini_tools):
-        """Google流式响应处理（新版 SDK）"""
-        try:
-            # 如果有工具，添加到 generation_config 中
-            if gemini_tools:
-                from google.genai import types
-                # 重新创建 config，添加 tools 参数
-                config_dict = generation_config.model_dump() if hasattr(generation_config, 'model_dump') else {}
-                config_dict['tools'] = gemini_tools
-                generation_config = types.GenerateContentConfig(**config_dict)
-
-            # 使用新版 SDK 的流式 API (不需要 await，直接返回异步迭代器)
-            response_stream = client.aio.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=generation_config
-            )
-
-            # 确保 response_stream 是异步迭代器而不是协程
-            if hasattr(response_stream, '__await__'):
-                # 如果是协程，需要 await 它
-                response_stream = await response_stream
+    async def _google_stream_completion(
+        self,
+        client,
+        model: str,
+        contents: List[Dict[str, Any]],
+        generation_config
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Google流式响应（新版 SDK）：收到数据即产出 Chat Completions 格式的增量块，最后一块带 finish_reason 和 usage"""
+        # 使用新版 SDK 的流式 API
+        # 注意：异步流式调用返回的是异步迭代器，直接使用不需要 await
+        response_stream = client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=generation_config
+        )
+
+        # 确保 response_stream 是异步迭代器而不是协程
+        if hasattr(response_stream, '__await__'):
+            # 如果是协程，需要 await 它
+            response_stream = await response_stream
+
+        # 同一个流的所有增量块共用一个 created（与 OpenAI 流式响应一致），时钟只读一次
+        now = time.time()
+        created = int(now)
+        message_id = f"gemini_{int(now * 1000)}"
+        finish_reason = None
+        usage_metadata = None
+
+        async for chunk in response_stream:
+            usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+            for candidate in getattr(chunk, 'candidates', None) or ():
+                finish_reason = getattr(candidate, 'finish_reason', None) or finish_reason
+                content = getattr(candidate, 'content', None)
+                # 处理每个 part（可能包含思维链和普通内容）
+                for part in getattr(content, 'parts', None) or ():
+                    text = getattr(part, 'text', None)
+                    if text:
+                        delta_key = "reasoning" if getattr(part, 'thought', False) else "content"
+                        yield self._gemini_stream_chunk(message_id, created, model, {delta_key: text})
+
+        # 发送完成信号
+        final_chunk = self._gemini_stream_chunk(
+            message_id, created, model, {}, self._convert_gemini_finish_reason(finish_reason)
+        )
+        final_chunk["usage"] = {
+            "prompt_tokens": getattr(usage_metadata, 'prompt_token_count', 0) or 0,
+            "completion_tokens": getattr(usage_metadata, 'candidates_token_count', 0) or 0,
+            "total_tokens": getattr(usage_metadata, 'total_token_count', 0) or 0
+        }
+        yield final_chunk
 
-            # 收集流式响应
-            full_text = ""
-            final_response = None
-            async for chunk in response_stream:
-                if hasattr(chunk, 'text') and chunk.text:
-                    full_text += chunk.text
-                final_response = chunk
+    @staticmethod
+    def _gemini_stream_chunk(
+        message_id: str,
+        created: int,
+        model: str,
+        delta: Dict[str, Any],
+        finish_reason: str = None
+    ) -> Dict[str, Any]:
+        """构造 Chat Completions 格式的流式增量块"""
+        return {
+            "id": message_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        }
 
-            return self._convert_gemini_response_to_openai_format(final_response, model)
+    @staticmethod
+    async def _collect_google_stream(
+        chunks: AsyncGenerator[Dict[str, Any], None],
+        model: str
+    ) -> Dict[str, Any]:
+        """把流式增量块聚合为完整的 Chat Completions 响应"""
+        content_parts = []
+        reasoning_parts = []
+        message_id = None
+        created = None
+        finish_reason = "stop"
+        usage = None
+
+        async for chunk in chunks:
+            message_id = chunk["id"]
+            created = chunk["created"]
+            choice = chunk["choices"][0]
+            delta = choice["delta"]
+            if "content" in delta:
+                content_parts.append(delta["content"])
+            elif "reasoning" in delta:
+                reasoning_parts.append(delta["reasoning"])
+            if choice["finish_reason"]:
+                finish_reason = choice["finish_reason"]
+                usage = chunk.get("usage")
+
+        message = {"role": "assistant", "content": "".join(content_parts)}
+        if reasoning_parts:
+            message["reasoning"] = "".join(reasoning_parts)
 
-        except Exception as e:
-            logger.error(f"Google流式响应失败: {str(e)}")
-            raise
+        return {
+            "id": message_id or f"gemini_{secrets.token_hex(4)}",
+            "object": "chat.completion",
+            "created": created or int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        }
 
     def _convert_gemini_response_to_openai_format(self, response, model):
         """将Gemini响应转换为OpenAI格式（包含搜索引用）"""
@@ -2136,41 +2178,44 @@ class AIProviderService:
 
         # 处理候选响应
         for i, candidate in enumerate(response.candidates):
-            content = ""
-            reasoning = ""  # 思维链内容
+            content_parts = []
+            reasoning_parts = []  # 思维链内容
             tool_calls = []
 
-            # 提取文本内容和思维链
+            # 提取文本内容和思维链（分段收集，最后一次拼接）
             for part in candidate.content.parts:
-                if hasattr(part, 'text') and part.text:
+                text = getattr(part, 'text', None)
+                if text:
                     # 检查是否为思维部分
-                    if hasattr(part, 'thought') and part.thought:
+                    if getattr(part, 'thought', False):
                         # 这是思维链部分
-                        reasoning += part.text
+                        reasoning_parts.append(text)
                     else:
                         # 这是普通文本内容
-                        content += part.text
-                elif hasattr(part, 'function_call'):
-                    # 处理函数调用
-                    func_call = part.function_call
+                        content_parts.append(text)
+                    continue
+
+                # 处理函数调用（新版 SDK 的 Part 总有 function_call 属性，未调用时为 None）
+                func_call = getattr(part, 'function_call', None)
+                if func_call is not None:
                     tool_calls.append({
-                        "id": f"call_{hash(func_call.name)}",
+                        "id": f"call_{secrets.token_hex(12)}",  # 每次调用唯一，同名函数多次调用不会冲突
                         "type": "function",
                         "function": {
                             "name": func_call.name,
-                            "arguments": json.dumps(dict(func_call.args))
+                            "arguments": orjson.dumps(dict(func_call.args or {})).decode()
                         }
                     })
 
             # 构建消息
             message = {
                 "role": "assistant",
-                "content": content
+                "content": "".join(content_parts)
             }
 
             # 添加思维链（如果有）
-            if reasoning:
-                message["reasoning"] = reasoning
+            if reasoning_parts:
+                message["reasoning"] = "".join(reasoning_parts)
 
             if tool_calls:
                 message["tool_calls"] = tool_calls
@@ -2188,7 +2233,7 @@ class AIProviderService:
             })
 
         return {
-            "id": f"gemini_{hash(str(response)) % 1000000}",
+            "id": f"gemini_{secrets.token_hex(4)}",
             "object": "chat.completion",
             "created": int(time.time()),
             "model": model,
@@ -2200,16 +2245,17 @@ class AIProviderService:
             }
         }
 
+    @staticmethod
+    def _approx_prompt_tokens(text: str) -> int:
+        """粗略估算提示词的 token 数（按空格计词，无需 split 分配列表）"""
+        return text.count(" ") + 1 if text else 0
+
     def _convert_gemini_finish_reason(self, finish_reason):
-        """转换Gemini finish_reason到OpenAI格式"""
-        mapping = {
-            "STOP": "stop",
-            "MAX_TOKENS": "length",
-            "SAFETY": "content_filter",
-            "RECITATION": "content_filter",
-            "OTHER": "stop"
-        }
-        return mapping.get(str(finish_reason), "stop")
+        """转换Gemini finish_reason到OpenAI格式
+
+        SDK 的 FinishReason 是 str 枚举，可直接按值查表（str() 会得到 "FinishReason.STOP"，查不到）
+        """
+        return self._GEMINI_FINISH_REASONS.get(finish_reason, "stop")
 
     async def _handle_google_imagen_generation(
         self,
@@ -2219,11 +2265,10 @@ class AIProviderService:
     ) -> Dict[str, Any]:
         """使用 Imagen API 生成图片（推荐方案）"""
         try:
-            from google import genai
             from google.genai import types
             import io
 
-            client = genai.Client(api_key=api_key)
+            client = self._get_genai_client(api_key)
 
             # 从工具配置中提取参数
             number_of_images = tool_config.get("n", 1)
@@ -2252,19 +2297,23 @@ class AIProviderService:
 
             logger.info(f"使用 Imagen API 生成图片: model={model}, aspect_ratio={aspect_ratio}, n={number_of_images}")
 
-            # 生成图片
-            response = client.models.generate_images(
-                model=model,
-                prompt=prompt,
-                config=types.GenerateImagesConfig(
-                    number_of_images=min(number_of_images, 4),
-                    aspect_ratio=aspect_ratio,
-                    safety_filter_level="block_some",
-                    person_generation="allow_all"
+            # 生成图片（异步接口，不阻塞事件循环）
+            async with asyncio.timeout(self.default_timeout * 2):  # 图像生成需要更长时间
+                response = await client.aio.models.generate_images(
+                    model=model,
+                    prompt=prompt,
+                    config=types.GenerateImagesConfig(
+                        number_of_images=min(number_of_images, 4),
+                        aspect_ratio=aspect_ratio,
+                        safety_filter_level="block_some",
+                        person_generation="allow_all"
+                    )
                 )
-            )
 
             # 处理响应
+            # 一次调用内的图片 ID 和 created 共用同一个时间戳
+            now = time.time()
+            now_ms = int(now * 1000)
             image_generations = []
             for i, generated_image in enumerate(response.generated_images):
                 # generated_image.image 是 PIL.Image 对象
@@ -2272,11 +2321,10 @@ class AIProviderService:
                 generated_image.image.save(img_bytes, format='PNG')
                 img_bytes.seek(0)
 
-                import base64
                 b64_data = base64.b64encode(img_bytes.read()).decode('utf-8')
 
                 image_generations.append({
-                    "id": f"img_{int(time.time() * 1000)}_{i}",
+                    "id": f"img_{now_ms}_{i}",
                     "type": "image_generation_call",
                     "status": "completed",
                     "result": {
@@ -2286,10 +2334,11 @@ class AIProviderService:
                     }
                 })
 
+            prompt_tokens = self._approx_prompt_tokens(prompt)
             return {
-                "id": f"imagen_{int(time.time() * 1000)}",
+                "id": f"imagen_{now_ms}",
                 "object": "chat.completion",
-                "created": int(time.time()),
+                "created": int(now),
                 "model": model,
                 "choices": [{
                     "index": 0,
@@ -2301,9 +2350,9 @@ class AIProviderService:
                     "finish_reason": "stop"
                 }],
                 "usage": {
-                    "prompt_tokens": len(prompt.split()),
+                    "prompt_tokens": prompt_tokens,
                     "completion_tokens": 0,
-                    "total_tokens": len(prompt.split())
+                    "total_tokens": prompt_tokens
                 }
             }
 
@@ -2318,41 +2367,33 @@ class AIProviderService:
         self,
         user_parts: List[Any],
         api_key: str,
-        tools: List[Dict[str, Any]],
+        image_gen_tool: Dict[str, Any],
         model: str
     ) -> Dict[str, Any]:
-        """处理Google图像生成工具调用"""
+        """处理Google图像生成工具调用（image_gen_tool 由调用方从工具列表中取出）"""
         try:
             genai.configure(api_key=api_key)
 
-            # 提取图像生成工具配置
-            image_gen_tool = None
-            for tool in tools:
-                if tool.get("type") == "image_generation":
-                    image_gen_tool = tool
-                    break
-
             if not image_gen_tool:
                 raise Exception("未找到图像生成工具配置")
 
-            # 构建图像生成提示
-            prompt_text = ""
+            # 构建图像生成提示（只在这里去掉一次首尾空白，后面直接复用）
             if isinstance(user_parts, list):
-                for part in user_parts:
-                    if isinstance(part, str):
-                        prompt_text += part + " "
-                    elif isinstance(part, dict) and "text" in part:
-                        prompt_text += part["text"] + " "
+                prompt_text = " ".join(
+                    part if isinstance(part, str) else part["text"]
+                    for part in user_parts
+                    if isinstance(part, str) or (isinstance(part, dict) and "text" in part)
+                ).strip()
             else:
-                prompt_text = str(user_parts)
+                prompt_text = str(user_parts).strip()
 
             if model.startswith("gemini-3"):
                 override_tool = dict(image_gen_tool)
                 override_tool["model"] = "imagen-4.0-generate-001"
-                return await self._handle_google_imagen_generation(prompt_text.strip(), api_key, override_tool)
+                return await self._handle_google_imagen_generation(prompt_text, api_key, override_tool)
 
             # 构建完整的图像生成提示
-            image_prompt = f"Generate an image: {prompt_text.strip()}"
+            image_prompt = f"Generate an image: {prompt_text}"
 
             # 根据工具配置调整提示
             style = image_gen_tool.get("style", "natural")
@@ -2374,19 +2415,19 @@ class AIProviderService:
             image_model = "gemini-2.5-flash-image" if model != "gemini-2.5-flash-image" else model
             model_instance = genai.GenerativeModel(image_model)
 
-            response = await asyncio.wait_for(
-                model_instance.generate_content_async(
+            async with asyncio.timeout(self.default_timeout * 2):  # 图像生成需要更长时间
+                response = await model_instance.generate_content_async(
                     image_prompt,
                     generation_config={
                         "temperature": 0.8,
                         "max_output_tokens": 8192,
                     }
-                ),
-                timeout=self.default_timeout * 2  # 图像生成需要更长时间
-            )
+                )
 
-            # 处理图像生成结果
+            # 处理图像生成结果（同一响应的所有 ID 和时间戳共用一次取得的时间）
             image_generations = []
+            now = time.time()
+            now_ms = int(now * 1000)
 
             # 检查响应中是否包含图片
             if hasattr(response, 'candidates') and response.candidates:
@@ -2405,14 +2446,15 @@ class AIProviderService:
                                     b64_data = image_data
 
                                 image_gen_result = {
-                                    "id": f"img_gen_{int(time.time() * 1000)}",
+                                    # 加序号区分同一响应中的多张图片
+                                    "id": f"img_gen_{now_ms}_{len(image_generations)}",
                                     "type": "image_generation_call",
                                     "status": "completed",
                                     "result": {
                                         "url": f"data:{mime_type};base64,{b64_data}",
                                         "b64_json": b64_data
                                     },
-                                    "revised_prompt": prompt_text.strip()
+                                    "revised_prompt": prompt_text
                                 }
                                 image_generations.append(image_gen_result)
 
@@ -2420,22 +2462,23 @@ class AIProviderService:
             if not image_generations and response.text:
                 # 创建一个表示图像生成调用的记录
                 image_gen_result = {
-                    "id": f"img_gen_{int(time.time() * 1000)}",
+                    "id": f"img_gen_{now_ms}",
                     "type": "image_generation_call",
                     "status": "completed",
                     "result": {
                         "description": response.text,
                         "note": "图像生成完成，但无法提取直接的图像数据"
                     },
-                    "revised_prompt": prompt_text.strip()
+                    "revised_prompt": prompt_text
                 }
                 image_generations.append(image_gen_result)
 
             # 构建OpenAI兼容的响应格式
+            prompt_tokens = self._approx_prompt_tokens(prompt_text)
             return {
-                "id": f"gemini_img_{int(time.time() * 1000)}",
+                "id": f"gemini_img_{now_ms}",
                 "object": "chat.completion",
-                "created": int(time.time()),
+                "created": int(now),
                 "model": image_model,
                 "choices": [{
                     "index": 0,
@@ -2447,19 +2490,20 @@ class AIProviderService:
                     "finish_reason": "stop"
                 }],
                 "usage": {
-                    "prompt_tokens": len(prompt_text.split()),
+                    "prompt_tokens": prompt_tokens,
                     "completion_tokens": 0,
-                    "total_tokens": len(prompt_text.split())
+                    "total_tokens": prompt_tokens
                 }
             }
 
         except Exception as e:
             logger.error(f"Google图像生成失败: {str(e)}")
             # 返回错误但保持OpenAI格式
+            now = time.time()
             return {
-                "id": f"gemini_img_error_{int(time.time() * 1000)}",
+                "id": f"gemini_img_error_{int(now * 1000)}",
                 "object": "chat.completion",
-                "created": int(time.time()),
+                "created": int(now),
                 "model": model,
                 "choices": [{
                     "index": 0,
@@ -2491,34 +2535,12 @@ class AIProviderService:
         """Google Gemini WebSocket流式响应"""
         try:
             # 创建客户端实例（新版 SDK）
-            client = genai.Client(api_key=api_key)
-
-            logger.info(f"开始Google流式调用: {model}")
-
-            # 转换消息格式和多模态内容
-            contents = []
-            system_instruction = None
+            client = self._get_genai_client(api_key)
 
-            # 处理系统消息
-            for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
+            logger.info("开始Google流式调用: %s", model)
 
-                if role == "system":
-                    system_instruction = content
-                    continue
-                elif role == "user":
-                    # 处理多模态内容
-                    parts = self._convert_message_to_gemini_parts(msg)
-                    contents.append({
-                        "role": "user",
-                        "parts": parts
-                    })
-                elif role == "assistant":
-                    contents.append({
-                        "role": "model",
-                        "parts": [{"text": content}]
-                    })
+            # 转换消息格式和多模态内容（Pydantic 消息先一次性转为字典）
+            contents, system_instruction = await self._build_gemini_contents_async(_as_message_dicts(messages))
 
             # 配置生成参数
             config_dict = {
@@ -2556,78 +2578,8 @@ class AIProviderService:
                     "parts": [{"text": f"System: {system_instruction}"}]
                 })
 
-            # 使用新版 SDK 的流式 API
-            # 注意：异步流式调用返回的是异步迭代器，直接使用不需要 await
-            response_stream = client.aio.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=generation_config
-            )
-
-            # 确保 response_stream 是异步迭代器而不是协程
-            if hasattr(response_stream, '__await__'):
-                # 如果是协程，需要 await 它
-                response_stream = await response_stream
-
-            accumulated_text = ""
-            accumulated_reasoning = ""
-            message_id = f"gemini_{int(time.time() * 1000)}"
-
-            async for chunk in response_stream:
-                # 处理每个 part（可能包含思维链和普通内容）
-                if hasattr(chunk, 'candidates') and chunk.candidates:
-                    for candidate in chunk.candidates:
-                        if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                            for part in candidate.content.parts:
-                                if hasattr(part, 'text') and part.text:
-                                    # 检查是否为思维部分
-                                    if hasattr(part, 'thought') and part.thought:
-                                        # 这是思维链部分
-                                        accumulated_reasoning += part.text
-                                        # 生成思维链流式响应块
-                                        yield {
-                                            "id": message_id,
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": model,
-                                            "choices": [{
-                                                "index": 0,
-                                                "delta": {
-                                                    "reasoning": part.text
-                                                },
-                                                "finish_reason": None
-                                            }]
-                                        }
-                                    else:
-                                        # 这是普通文本内容
-                                        accumulated_text += part.text
-                                        # 生成普通内容流式响应块
-                                        yield {
-                                            "id": message_id,
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": model,
-                                            "choices": [{
-                                                "index": 0,
-                                                "delta": {
-                                                    "content": part.text
-                                                },
-                                                "finish_reason": None
-                                            }]
-                                        }
-
-            # 发送完成信号
-            yield {
-                "id": message_id,
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": model,
-                "choices": [{
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }]
-            }
+            async for chunk in self._google_stream_completion(client, model, contents, generation_config):
+                yield chunk
 
         except Exception as e:
             logger.error(f"Google流式调用失败: {str(e)}")
@@ -2651,20 +2603,15 @@ class AIProviderService:
             if not base_url:
                 base_url = "https://api.openai.com/v1"
             
-            client = openai.AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url,
-                timeout=self.default_timeout
-            )
+            client = self._get_openai_client(api_key, base_url)
             
-            logger.info(f"调用OpenAI兼容API模型: {model}, 消息数量: {len(messages)}, 基础URL: {base_url}")
+            logger.info("调用OpenAI兼容API模型: %s, 消息数量: %s, 基础URL: %s", model, len(messages), base_url)
             
             # 转换消息格式 - 只支持基本的文本消息格式
-            converted_messages = []
-            for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
-                converted_messages.append({"role": role, "content": content})
+            message_parts = self._message_parts
+            converted_messages = [
+                {"role": role, "content": content} for role, content in map(message_parts, messages)
+            ]
             
             # 基础完成参数（OpenAI兼容提供商只支持纯文本对话）
             completion_params = {
@@ -2675,27 +2622,24 @@ class AIProviderService:
                 "max_tokens": 4000
             }
             
-            response = await asyncio.wait_for(
-                client.chat.completions.create(**completion_params),
-                timeout=self.default_timeout
-            )
+            response = await client.chat.completions.create(**completion_params)
             
-            result = response.model_dump()
-            logger.info(f"OpenAI兼容API调用成功，返回选择数量: {len(result.get('choices', []))}")
+            result = response.model_dump(mode="json", exclude_unset=True, exclude_none=True)
+            logger.info("OpenAI兼容API调用成功，返回选择数量: %s", len(result.get('choices', [])))
             return result
             
         except openai.AuthenticationError as e:
-            logger.error(f"OpenAI兼容API认证失败: {str(e)}")
-            raise Exception("OpenAI兼容API密钥无效，请检查您的API密钥")
+            logger.error("OpenAI兼容API认证失败: %s", str(e))
+            raise Exception("OpenAI兼容API密钥无效，请检查您的API密钥") from e
         except openai.RateLimitError as e:
-            logger.error(f"OpenAI兼容API速率限制: {str(e)}")
-            raise Exception("OpenAI兼容API请求频率过高，请稍后重试")
+            logger.error("OpenAI兼容API速率限制: %s", str(e))
+            raise Exception("OpenAI兼容API请求频率过高，请稍后重试") from e
         except openai.InternalServerError as e:
-            logger.error(f"OpenAI兼容API服务器错误: {str(e)}")
-            raise Exception("OpenAI兼容API服务器暂时不可用，请稍后重试")
+            logger.error("OpenAI兼容API服务器错误: %s", str(e))
+            raise Exception("OpenAI兼容API服务器暂时不可用，请稍后重试") from e
         except Exception as e:
-            logger.error(f"OpenAI兼容API调用异常: {str(e)}")
-            raise Exception(f"OpenAI兼容API调用失败: {str(e)}")
+            logger.error("OpenAI兼容API调用异常: %s", str(e))
+            raise Exception(f"OpenAI兼容API调用失败: {str(e)}") from e
 
     async def stream_completion(
         self,
@@ -2707,43 +2651,152 @@ class AIProviderService:
         reasoning_summaries: str = "auto",
         reasoning: str = "medium",
         tools: List[Dict[str, Any]] = None,
-        use_native_search: bool = None
+        use_native_search: bool = None,
+        bypass_cache: bool = False
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """流式完成（WebSocket使用），bypass_cache 为 True 时不回放缓存的响应"""
+        cache = None if tools else self._get_response_cache()
+        if cache is None:
+            async for chunk in self._stream_completion_uncached(
+                provider, model, messages, api_key, thinking_mode,
+                reasoning_summaries, reasoning, tools, use_native_search
+            ):
+                yield chunk
+            return
+
+        cache_key = cache.make_key(
+            provider, model, messages,
+            api_key=api_key,
+            stream=True,
+            thinking_mode=thinking_mode,
+            reasoning_summaries=reasoning_summaries,
+            reasoning=reasoning,
+            use_native_search=use_native_search
+        )
+        def produce():
+            return self._stream_completion_uncached(
+                provider, model, messages, api_key, thinking_mode,
+                reasoning_summaries, reasoning, tools, use_native_search
+            )
+
+        async for chunk in cache.stream_with_cache(cache_key, produce, refresh=bypass_cache):
+            yield chunk
+
+    async def _stream_completion_uncached(
+        self,
+        provider: str,
+        model: str,
+        messages: List[Union[Dict[str, str], Any]],
+        api_key: str,
+        thinking_mode: bool,
+        reasoning_summaries: str,
+        reasoning: str,
+        tools: List[Dict[str, Any]],
+        use_native_search: bool
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        """流式完成（WebSocket使用）"""
-        logger.info(f"开始流式调用 {provider} API")
+        """按提供商分发流式调用"""
+        logger.info("开始流式调用 %s API", provider)
         
         try:
-            if provider == "openai":
-                # 检查模型是否支持流式输出
-                if await self._supports_streaming(provider, model):
-                    async for chunk in self._openai_stream_completion(model, messages, api_key, thinking_mode, reasoning_summaries, reasoning, tools, use_native_search):
-                        yield chunk
-                else:
-                    # 不支持流式的模型，直接返回完整响应
-                    logger.info(f"模型 {model} 不支持流式输出，使用普通请求")
-                    response = await self.get_completion(provider, model, messages, api_key, False, thinking_mode, reasoning_summaries, reasoning, tools, use_native_search)
-                    yield response
-            elif provider == "anthropic":
-                # Anthropic支持流式输出
-                async for chunk in self._anthropic_stream_completion(model, messages, api_key, thinking_mode, reasoning_summaries, tools, use_native_search):
-                    yield chunk
-            elif provider == "google":
-                # Google Gemini支持流式输出
-                async for chunk in self._google_stream_completion_websocket(model, messages, api_key, thinking_mode, reasoning_summaries, reasoning, tools, use_native_search):
-                    yield chunk
-            elif provider == "openai_compatible":
-                # OpenAI兼容提供商支持流式
-                async for chunk in self._openai_compatible_stream_completion(model, messages, api_key, thinking_mode, reasoning_summaries, tools, use_native_search):
-                    yield chunk
-            else:
-                # 其他提供商暂不支持流式
-                response = await self.get_completion(provider, model, messages, api_key, False, thinking_mode, reasoning_summaries, reasoning)
+            method_name = self._STREAM_METHODS.get(provider)
+            # OpenAI 需要检查模型是否支持流式输出
+            if method_name is not None and provider == "openai" and not await self._supports_streaming(provider, model):
+                logger.info("模型 %s 不支持流式输出，使用普通请求", model)
+                method_name = None
+
+            if method_name is None:
+                # 不支持流式的模型或提供商，直接返回完整响应
+                response = await self.get_completion(provider, model, messages, api_key, False, thinking_mode, reasoning_summaries, reasoning, tools, use_native_search)
                 yield response
+                return
+
+            chunks = getattr(self, method_name)(model, messages, api_key, thinking_mode, reasoning_summaries, reasoning, tools, use_native_search)
+            async for chunk in self._coalesce_deltas(chunks, self.stream_coalesce_delay, self.stream_coalesce_chars):
+                yield chunk
                 
         except Exception as e:
-            logger.error(f"流式调用失败: {str(e)}")
+            logger.error("流式调用失败: %s", str(e))
             yield {"error": str(e)}
 
+    @staticmethod
+    def _delta_text(chunk: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """纯文本增量块（delta 只有 content 或 reasoning）返回 (字段名, 文本)，其他数据块返回 None"""
+        choices = chunk.get("choices")
+        if not choices or len(choices) != 1 or "usage" in chunk:
+            return None
+        choice = choices[0]
+        delta = choice.get("delta")
+        if choice.get("finish_reason") is not None or not delta or len(delta) != 1:
+            return None
+        key, text = next(iter(delta.items()))
+        if key not in ("content", "reasoning") or not isinstance(text, str):
+            return None
+        return key, text
+
+    @classmethod
+    async def _coalesce_deltas(
+        cls,
+        chunks: AsyncGenerator[Dict[str, Any], None],
+        max_delay: float,
+        max_chars: int
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """合并连续到达的文本增量，减少 WebSocket 帧数和序列化次数
+
+        在当前任务内逐块读取上游，上游生成器的 async with 上下文始终在同一任务中进入和退出。
+        文本累计超过 max_chars、缓冲的第一段文本已超过 max_delay 秒（在下一块到达时检查）、
+        遇到其他类型的数据块或流结束时发送；其他数据块原样按顺序转发。
+        上游抛出异常时先发送已缓冲的文本再向上抛出。
+        """
+        loop = asyncio.get_running_loop()
+        buffer = []
+        buffered_chars = 0
+        first_chunk = None
+        buffer_key = None
+        deadline = 0.0
+
+        def flush() -> Dict[str, Any]:
+            nonlocal buffered_chars, first_chunk
+            choice = first_chunk["choices"][0]
+            merged = {**first_chunk, "choices": [{**choice, "delta": {buffer_key: "".join(buffer)}}]}
+            buffer.clear()
+            buffered_chars = 0
+            first_chunk = None
+            return merged
+
+        try:
+            async for chunk in chunks:
+                delta_text = cls._delta_text(chunk) if isinstance(chunk, dict) else None
+                if delta_text is None:
+                    if first_chunk is not None:
+                        yield flush()
+                    yield chunk
+                    continue
+
+                key, text = delta_text
+                if first_chunk is not None and key != buffer_key:
+                    yield flush()
+                if first_chunk is None:
+                    first_chunk = chunk
+                    buffer_key = key
+                    deadline = loop.time() + max_delay
+                buffer.append(text)
+                buffered_chars += len(text)
+                if buffered_chars >= max_chars or loop.time() >= deadline:
+                    yield flush()
+        except Exception:
+            # 只处理上游错误；调用方关闭（GeneratorExit）或取消时不能再 yield
+            if first_chunk is not None:
+                yield flush()
+            raise
+        finally:
+            # 调用方提前结束时关闭上游生成器
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+        if first_chunk is not None:
+            yield flush()
+
     async def _openai_stream_completion(
         self,
         model: str,
@@ -2758,25 +2811,27 @@ class AIProviderService:
         """OpenAI流式完成 - 使用 Responses API"""
         try:
             # GPT-5 推理模型需要更长的超时时间
-            timeout = self.responses_api_timeout if self._is_gpt5_model(model) else self.default_timeout
+            is_gpt5 = self._is_gpt5_model(model)
+            timeout = self.responses_api_timeout if is_gpt5 else self.default_timeout
 
-            client = openai.AsyncOpenAI(
-                api_key=api_key,
-                timeout=timeout
-            )
-
-            logger.info(f"OpenAI流式调用，模型: {model}，超时时间: {timeout}秒")
+            client = self._get_openai_client(api_key, timeout=timeout)
 
-            # 准备工具配置
-            tools_config = self._prepare_tools_config(messages, tools, "openai")
+            logger.info("OpenAI流式调用，模型: %s，超时时间: %s秒", model, timeout)
 
-            # 转换消息为 Responses API 格式
+            # 单次遍历：转换消息为 Responses API 格式，同时收集文件所需的工具
             input_messages = []
             instructions_text = ""
+            need_code_interpreter = False
+            vector_stores = set()
 
             for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
+                view = _msg_view(msg)
+                role = view.get("role", "")
+                content = view.get("content", "")
+
+                files = view.get("files")
+                if files and self._collect_file_tools(files, vector_stores):
+                    need_code_interpreter = True
 
                 if role == "system":
                     # system 消息转换为 instructions
@@ -2788,199 +2843,61 @@ class AIProviderService:
                         "content": content
                     })
 
-            # 构建 Responses API 参数
-            stream_params = {
-                "model": model,
-                "input": input_messages,
-                "stream": True
-            }
-
-            # 添加 instructions
-            if instructions_text:
-                stream_params["instructions"] = instructions_text
-
-            # 添加工具配置 (传递原始字典而不是Pydantic模型)
-            if tools_config["tools"]:
-                # 转换工具配置为原始字典格式，避免Pydantic序列化警告
-                stream_params["tools"] = [
-                    tool if isinstance(tool, dict) else tool
-                    for tool in tools_config["tools"]
-                ]
-
-            # GPT-5 系列模型不支持自定义 temperature，使用默认值 1
-            if not self._is_gpt5_model(model):
-                stream_params["temperature"] = 0.7
+            tools_config = self._build_openai_tools_config(need_code_interpreter, vector_stores, tools)
 
-            # 使用 max_output_tokens（Responses API 的参数）
-            stream_params["max_output_tokens"] = 4000
-
-            # 如果是 GPT-5 模型，添加 reasoning 参数
-            if self._is_gpt5_model(model):
+            # 构建 Responses API 参数
+            if is_gpt5:
                 # 将前端的 reasoning 值映射到 OpenAI Responses API 的 reasoning.effort 格式
-                has_image_gen_tool = tools and any(tool.get("type") == "image_generation" for tool in tools)
+                has_image_gen_tool = self._find_tool(tools, "image_generation") is not None
                 effort_value = self._map_reasoning_effort(model, reasoning, has_image_gen_tool)
-
-                stream_params["reasoning"] = {
-                    "effort": effort_value,
-                    "summary": reasoning_summaries if reasoning_summaries != "auto" else "auto"
-                }
+                stream_params = self._build_responses_params(
+                    model, input_messages, instructions_text, tools_config["tools"],
+                    reasoning={"effort": effort_value, "summary": reasoning_summaries}
+                )
+            else:
+                # GPT-5 系列模型不支持自定义 temperature，其他模型使用 0.7
+                stream_params = self._build_responses_params(
+                    model, input_messages, instructions_text, tools_config["tools"],
+                    temperature=0.7
+                )
+            stream_params["stream"] = True
 
             # 使用 Responses API 进行流式调用
             stream = await client.responses.create(**stream_params)
 
+            # 按事件类型查表分发，每个事件只做一次类型查找
+            event_handlers = RESPONSES_STREAM_EVENT_HANDLERS
+            ignored_events = RESPONSES_IGNORED_STREAM_EVENTS
+            yield_every = self._STREAM_YIELD_EVERY
+            event_count = 0
             async for event in stream:
-                # 转换 Responses API 事件为 Chat Completions 格式
-                event_dict = event.model_dump() if hasattr(event, 'model_dump') else event
-                event_type = event_dict.get('type', '')
-                logger.info(f"收到 Responses API 事件: {event_type}")
-
-                # 处理reasoning summary事件
-                if event_type == 'response.reasoning_summary_part.done':
-                    # 获取reasoning summary文本
-                    part = event_dict.get('part', {})
-                    summary_text = part.get('text', '')
-                    if summary_text:
-                        # 发送reasoning summary作为特殊消息
-                        yield {
-                            'choices': [{
-                                'delta': {
-                                    'reasoning': summary_text
-                                },
-                                'index': 0,
-                                'finish_reason': None
-                            }]
-                        }
-                        logger.info(f"收到 reasoning summary，长度: {len(summary_text)}")
-
-                # 处理文本增量事件
-                elif event_type == 'response.output_text.delta':
-                    yield {
-                        'choices': [{
-                            'delta': {
-                                'content': event_dict.get('delta', '')
-                            },
-                            'index': 0,
-                            'finish_reason': None
-                        }]
-                    }
-
-                # 处理图片生成调用完成事件
-                elif event_type == 'response.image_generation_call.done':
-                    logger.info(f"收到图片生成完成事件，完整数据: {event_dict}")
-                    image_data = event_dict.get('image_generation_call', {})
-                    logger.info(f"提取的 image_data: {image_data}")
-                    image_result = {
-                        'id': image_data.get('id'),
-                        'type': 'image_generation_call',
-                        'status': image_data.get('status', 'completed'),
-                        'result': image_data.get('result'),
-                        'revised_prompt': image_data.get('revised_prompt')
-                    }
-                    logger.info(f"构建的 image_result: {image_result}")
-
-                    # 发送包含图片生成结果的事件
-                    yield {
-                        'choices': [{
-                            'delta': {
-                                'image_generation': image_result
-                            },
-                            'index': 0,
-                            'finish_reason': None
-                        }]
-                    }
-                    logger.info(f"已发送图片生成结果: {image_result.get('id')}")
-
-                # 处理完成事件
-                elif event_type == 'response.completed':
-                    logger.info("收到 response.completed 事件，发送 finish_reason: stop")
-                    yield {
-                        'choices': [{
-                            'delta': {},
-                            'index': 0,
-                            'finish_reason': 'stop'
-                        }]
-                    }
-                    logger.info("已发送 finish_reason: stop 到前端")
-
-                # 处理错误事件
-                elif event_type == 'response.failed':
-                    error_info = event_dict.get('response', {}).get('error', {})
-                    yield {
-                        'error': error_info.get('message', 'Unknown error')
-                    }
-
-                # 处理 output_item.done 事件（可能包含图片生成结果）
-                elif event_type == 'response.output_item.done':
-                    item = event_dict.get('item', {})
-                    item_type = item.get('type', '')
-                    logger.info(f"收到 output_item.done 事件，类型: {item_type}")
-
-                    # 检查是否是图片生成结果
-                    if item_type == 'image_generation_call':
-                        logger.info(f"检测到图片生成结果，完整数据: {item}")
-                        image_result = {
-                            'id': item.get('id'),
-                            'type': 'image_generation_call',
-                            'status': item.get('status', 'completed'),
-                            'result': item.get('result'),
-                            'revised_prompt': item.get('revised_prompt')
-                        }
-                        logger.info(f"构建的 image_result: {image_result}")
-
-                        yield {
-                            'choices': [{
-                                'delta': {
-                                    'image_generation': image_result
-                                },
-                                'index': 0,
-                                'finish_reason': None
-                            }]
-                        }
-                        logger.info(f"已发送图片生成结果: {image_result.get('id')}")
-                    continue
-
-                # 忽略但记录的事件（这些事件不需要发送给前端，但表示流仍在进行）
-                elif event_type in [
-                    'response.created',
-                    'response.in_progress',
-                    'response.output_item.added',
-                    'response.content_part.added',
-                    'response.content_part.done',
-                    'response.output_text.done',
-                    'response.reasoning_summary_part.added',
-                    'response.reasoning_summary_text.delta',
-                    'response.reasoning_summary_text.done',
-                    'response.web_search_call.in_progress',
-                    'response.web_search_call.searching',
-                    'response.web_search_call.completed',
-                    'response.file_search_call.in_progress',
-                    'response.file_search_call.searching',
-                    'response.file_search_call.completed',
-                    'response.image_generation_call.in_progress',
-                    'response.image_generation_call.generating',
-                    'response.image_generation_call.partial_image',
-                    'response.mcp_list_tools.in_progress',
-                    'response.mcp_list_tools.completed',
-                    'response.mcp_call.in_progress',
-                    'response.mcp_call_arguments.delta',
-                    'response.mcp_call_arguments.done',
-                    'response.mcp_call.completed',
-                ]:
-                    # 这些事件不需要转换，但我们需要继续循环
-                    # 可以在这里添加日志记录
-                    logger.debug(f"收到 Responses API 事件: {event_type}")
-                    continue
-
-                # 未知事件类型
-                else:
-                    logger.warning(f"未处理的 Responses API 事件类型: {event_type}")
+                # 已缓冲的事件会连续同步处理，定期让出事件循环，避免其他连接的流被饿死
+                event_count += 1
+                if not event_count % yield_every:
+                    await asyncio.sleep(0)
+
+                # 转换 Responses API 事件为 Chat Completions 格式（直接读取字段，不做 model_dump）
+                event_type = getattr(event, 'type', '')
+
+                handler = event_handlers.get(event_type)
+                if handler is not None:
+                    chunk = handler(event)
+                    if chunk is not None:
+                        yield chunk
+                elif event_type in ignored_events:
+                    # 这些事件不需要发送给前端，但表示流仍在进行
+                    logger.debug("收到 Responses API 事件: %s", event_type)
+                elif event_type not in self._unknown_stream_events:
+                    # 未知事件类型：每种类型只警告一次，避免每个事件都写一条警告
+                    self._unknown_stream_events.add(event_type)
+                    logger.warning("未处理的 Responses API 事件类型: %s", event_type)
 
         except Exception as e:
             import traceback
             error_msg = str(e) if str(e) else repr(e)
-            logger.error(f"OpenAI流式调用失败: {error_msg}")
-            logger.error(f"异常类型: {type(e).__name__}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
+            logger.error("OpenAI流式调用失败: %s", error_msg)
+            logger.error("异常类型: %s", type(e).__name__)
+            logger.error("Traceback: %s", traceback.format_exc())
             yield {"error": error_msg or "未知错误"}
 
     async def _openai_compatible_stream_completion(
@@ -2990,6 +2907,7 @@ class AIProviderService:
         api_key: str,
         thinking_mode: bool = False,
         reasoning_summaries: str = "auto",
+        reasoning: str = "medium",
         tools: List[Dict[str, Any]] = None,
         use_native_search: bool = None,
         base_url: str = None
@@ -3000,18 +2918,13 @@ class AIProviderService:
             if not base_url:
                 base_url = "https://api.openai.com/v1"
                 
-            client = openai.AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url,
-                timeout=self.default_timeout
-            )
+            client = self._get_openai_client(api_key, base_url)
             
             # 转换消息格式 - 只支持基本的文本消息格式
-            converted_messages = []
-            for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
-                converted_messages.append({"role": role, "content": content})
+            message_parts = self._message_parts
+            converted_messages = [
+                {"role": role, "content": content} for role, content in map(message_parts, messages)
+            ]
             
             # 流式参数
             stream_params = {
@@ -3025,12 +2938,31 @@ class AIProviderService:
             stream = await client.chat.completions.create(**stream_params)
             
             async for chunk in stream:
-                yield chunk.model_dump()
+                yield self._compat_stream_chunk(chunk)
                 
         except Exception as e:
-            logger.error(f"OpenAI兼容流式调用失败: {str(e)}")
+            logger.error("OpenAI兼容流式调用失败: %s", str(e))
             yield {"error": str(e)}
 
+    @staticmethod
+    def _compat_stream_chunk(chunk: Any) -> Dict[str, Any]:
+        """只取前端用到的字段构造流式数据块，不对每个数据块做完整的 model_dump"""
+        choices = []
+        for choice in chunk.choices or ():
+            delta = {}
+            source = choice.delta
+            if source is not None:
+                if source.role is not None:
+                    delta["role"] = source.role
+                if source.content is not None:
+                    delta["content"] = source.content
+            choices.append({
+                "index": choice.index,
+                "delta": delta,
+                "finish_reason": choice.finish_reason
+            })
+        return {"id": chunk.id, "choices": choices}
+
     async def _anthropic_stream_completion(
         self,
         model: str,
@@ -3038,32 +2970,18 @@ class AIProviderService:
         api_key: str,
         thinking_mode: bool = False,
         reasoning_summaries: str = "auto",
+        reasoning: str = "medium",
         tools: List[Dict[str, Any]] = None,
         use_native_search: bool = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """Anthropic流式完成，支持Extended Thinking、Vision、Citations等功能"""
         try:
-            client = anthropic.AsyncAnthropic(
-                api_key=api_key,
-                timeout=self.default_timeout
-            )
-            
-            logger.info(f"开始Anthropic流式调用: {model}, 扩展思考模式: {thinking_mode}")
+            client = self._get_anthropic_client(api_key)
             
-            system_message = ""
-            user_messages = []
+            logger.info("开始Anthropic流式调用: %s, 扩展思考模式: %s", model, thinking_mode)
             
-            # 转换消息格式以支持多媒体内容
-            for msg in messages:
-                role = self._get_message_attr(msg, "role")
-                content = self._get_message_attr(msg, "content")
-                
-                if role == "system":
-                    system_message = content
-                else:
-                    # 转换为Anthropic Messages API格式
-                    converted_msg = self._convert_message_to_anthropic_format(msg)
-                    user_messages.append(converted_msg)
+            # 转换消息格式以支持多媒体内容（Pydantic 消息先一次性转为字典）
+            system_message, user_messages = self._split_anthropic_messages(_as_message_dicts(messages))
             
             # Extended Thinking支持 - 需要先确定是否启用思考模式
             thinking_budget_tokens = 10000 if thinking_mode else 0
@@ -3086,15 +3004,15 @@ class AIProviderService:
                     "type": "enabled",
                     "budget_tokens": thinking_budget_tokens
                 }
-                logger.info(f"启用Claude流式扩展思考模式，budget_tokens: {thinking_budget_tokens}, max_tokens: {stream_params['max_tokens']}, temperature: 1")
+                logger.info("启用Claude流式扩展思考模式，budget_tokens: %s, max_tokens: %s, temperature: 1", thinking_budget_tokens, stream_params['max_tokens'])
             
             # 工具配置（如果有）
             if tools:
-                logger.info(f"收到工具配置: {tools}")
+                logger.info("收到工具配置: %s", tools)
                 anthropic_tools = self._convert_tools_to_anthropic_format(tools)
                 if anthropic_tools:
                     stream_params["tools"] = anthropic_tools
-                    logger.info(f"已添加工具到stream_params: {anthropic_tools}")
+                    logger.info("已添加工具到stream_params: %s", anthropic_tools)
                 else:
                     logger.warning("工具转换后为空列表")
             else:
@@ -3105,126 +3023,141 @@ class AIProviderService:
             if uses_files_api:
                 stream_params["betas"] = ["files-api-2025-04-14"]
                 logger.info("流式调用检测到Files API使用，已添加betas参数")
+
+            # 与非流式调用相同的提示缓存断点
+            self._apply_anthropic_prompt_cache(stream_params)
             
             # 创建流式响应
-            content_text = ""
-            thinking_content = ""
-            message_id = None
+            # 只在结束日志中用到长度，按长度累计而不拼接文本
+            content_length = 0
+            thinking_length = 0
+            # 数据块 ID 在 message_start 时确定一次，之后每个增量直接复用
+            chunk_id = "msg_stream"
             current_citations = []
             
             # 根据是否使用Files API选择正确的客户端方法
             stream_context = client.beta.messages.stream(**stream_params) if uses_files_api else client.messages.stream(**stream_params)
             
+            yield_every = self._STREAM_YIELD_EVERY
+            event_count = 0
             async with stream_context as stream:
                 async for event in stream:
+                    # 已缓冲的事件会连续同步处理，定期让出事件循环，避免其他连接的流被饿死
+                    event_count += 1
+                    if not event_count % yield_every:
+                        await asyncio.sleep(0)
+
                     try:
-                        # 根据事件类型处理不同的流式数据
-                        if hasattr(event, 'type'):
-                            if event.type == "message_start":
-                                # 消息开始
-                                if hasattr(event, 'message') and hasattr(event.message, 'id'):
-                                    message_id = event.message.id
-                                
-                                # 发送初始chunk
+                        # 根据事件类型处理不同的流式数据（事件属性各读取一次）
+                        event_type = getattr(event, 'type', None)
+                        if event_type == "message_start":
+                            # 消息开始
+                            message_id = getattr(getattr(event, 'message', None), 'id', None)
+                            if message_id:
+                                chunk_id = f"msg_{message_id}"
+
+                            # 发送初始chunk
+                            chunk = {
+                                "id": chunk_id,
+                                "choices": [{
+                                    "delta": {
+                                        "role": "assistant",
+                                        "content": ""
+                                    },
+                                    "index": 0,
+                                    "finish_reason": None
+                                }]
+                            }
+                            yield chunk
+
+                        elif event_type == "content_block_start":
+                            # 内容块开始 - 可能是text或thinking
+                            content_block = getattr(event, 'content_block', None)
+                            if content_block is not None and thinking_mode and getattr(content_block, 'type', 'text') == "thinking":
+                                logger.debug("开始接收thinking内容")
+
+                        elif event_type == "content_block_delta":
+                            # 内容增量
+                            delta = getattr(event, 'delta', None)
+                            if delta is None:
+                                continue
+                            delta_type = getattr(delta, 'type', 'text_delta')
+
+                            if delta_type == "text_delta":
+                                # 文本增量
+                                text_delta = getattr(delta, 'text', '')
+                                content_length += len(text_delta)
+
                                 chunk = {
-                                    "id": f"msg_{message_id or 'stream'}",
+                                    "id": chunk_id,
                                     "choices": [{
                                         "delta": {
-                                            "role": "assistant",
-                                            "content": ""
+                                            "content": text_delta
                                         },
                                         "index": 0,
                                         "finish_reason": None
                                     }]
                                 }
                                 yield chunk
-                            
-                            elif event.type == "content_block_start":
-                                # 内容块开始 - 可能是text或thinking
-                                if hasattr(event, 'content_block'):
-                                    block_type = getattr(event.content_block, 'type', 'text')
-                                    if block_type == "thinking" and thinking_mode:
-                                        logger.debug("开始接收thinking内容")
-                            
-                            elif event.type == "content_block_delta":
-                                # 内容增量
-                                if hasattr(event, 'delta'):
-                                    delta_type = getattr(event.delta, 'type', 'text_delta')
-                                    
-                                    if delta_type == "text_delta":
-                                        # 文本增量
-                                        text_delta = getattr(event.delta, 'text', '')
-                                        content_text += text_delta
-                                        
-                                        chunk = {
-                                            "id": f"msg_{message_id or 'stream'}",
-                                            "choices": [{
-                                                "delta": {
-                                                    "content": text_delta
-                                                },
-                                                "index": 0,
-                                                "finish_reason": None
-                                            }]
-                                        }
-                                        yield chunk
-                                    
-                                    elif delta_type == "thinking_delta" and thinking_mode:
-                                        # 思考增量
-                                        thinking_delta = getattr(event.delta, 'content', '') or getattr(event.delta, 'thinking', '')
-                                        thinking_content += thinking_delta
-                                        
-                                        # 思考内容作为reasoning字段发送
-                                        chunk = {
-                                            "id": f"msg_{message_id or 'stream'}",
-                                            "choices": [{
-                                                "delta": {
-                                                    "reasoning": thinking_delta
-                                                },
-                                                "index": 0,
-                                                "finish_reason": None
-                                            }]
-                                        }
-                                        yield chunk
-                                    
-                                    elif delta_type == "citations_delta":
-                                        # Citations增量
-                                        if hasattr(event.delta, 'citation'):
-                                            citation = {
-                                                "type": getattr(event.delta.citation, 'type', 'unknown'),
-                                                "cited_text": getattr(event.delta.citation, 'cited_text', ''),
-                                                "source": getattr(event.delta.citation, 'source', ''),
-                                                "title": getattr(event.delta.citation, 'title', ''),
-                                                "document_index": getattr(event.delta.citation, 'document_index', 0)
-                                            }
-                                            current_citations.append(citation)
-                            
-                            elif event.type == "message_delta":
-                                # 消息级别的增量，通常包含停止原因
-                                if hasattr(event, 'delta') and hasattr(event.delta, 'stop_reason'):
-                                    stop_reason = self._map_anthropic_stop_reason(event.delta.stop_reason)
-                                    
-                                    chunk = {
-                                        "id": f"msg_{message_id or 'stream'}",
-                                        "choices": [{
-                                            "delta": {},
-                                            "index": 0,
-                                            "finish_reason": stop_reason
-                                        }]
-                                    }
-                                    
-                                    # 如果有citations，在最后的chunk中包含
-                                    if current_citations:
-                                        chunk["choices"][0]["delta"]["citations"] = current_citations
-                                    
-                                    yield chunk
-                            
-                            elif event.type == "message_stop":
-                                # 消息结束
-                                logger.info(f"Anthropic流式调用完成，总文本长度: {len(content_text)}, thinking长度: {len(thinking_content)}")
-                                break
-                    
+
+                            elif delta_type == "thinking_delta" and thinking_mode:
+                                # 思考增量
+                                thinking_delta = getattr(delta, 'content', '') or getattr(delta, 'thinking', '')
+                                thinking_length += len(thinking_delta)
+
+                                # 思考内容作为reasoning字段发送
+                                chunk = {
+                                    "id": chunk_id,
+                                    "choices": [{
+                                        "delta": {
+                                            "reasoning": thinking_delta
+                                        },
+                                        "index": 0,
+                                        "finish_reason": None
+                                    }]
+                                }
+                                yield chunk
+
+                            elif delta_type == "citations_delta":
+                                # Citations增量
+                                citation = getattr(delta, 'citation', None)
+                                if citation is not None:
+                                    current_citations.append({
+                                        "type": getattr(citation, 'type', 'unknown'),
+                                        "cited_text": getattr(citation, 'cited_text', ''),
+                                        "source": getattr(citation, 'source', ''),
+                                        "title": getattr(citation, 'title', ''),
+                                        "document_index": getattr(citation, 'document_index', 0)
+                                    })
+
+                        elif event_type == "message_delta":
+                            # 消息级别的增量，通常包含停止原因
+                            delta = getattr(event, 'delta', None)
+                            if delta is not None and hasattr(delta, 'stop_reason'):
+                                stop_reason = self._map_anthropic_stop_reason(delta.stop_reason)
+
+                                chunk = {
+                                    "id": chunk_id,
+                                    "choices": [{
+                                        "delta": {},
+                                        "index": 0,
+                                        "finish_reason": stop_reason
+                                    }]
+                                }
+
+                                # 如果有citations，在最后的chunk中包含
+                                if current_citations:
+                                    chunk["choices"][0]["delta"]["citations"] = current_citations
+
+                                yield chunk
+
+                        elif event_type == "message_stop":
+                            # 消息结束
+                            logger.info("Anthropic流式调用完成，总文本长度: %s, thinking长度: %s", content_length, thinking_length)
+                            break
+
                     except Exception as e:
-                        logger.error(f"处理Anthropic流式事件时出错: {str(e)}")
+                        logger.error("处理Anthropic流式事件时出错: %s", e)
                         continue
                         
         except anthropic.AuthenticationError as e:
@@ -3236,3 +3169,9 @@ class AIProviderService:
         except Exception as e:
             logger.error(f"Anthropic流式调用失败: {str(e)}")
             yield {"error": f"Anthropic流式调用失败: {str(e)}"}
+
+
+@lru_cache(maxsize=None)
+def get_ai_service() -> AIProviderService:
+    """获取共享的 AI 服务实例（服务无请求级状态，可在请求间复用）"""
+    return AIProviderService()
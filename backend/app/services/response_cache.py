@@ -0,0 +1,144 @@
+"""
+Response Cache Service
+进程内的对话响应缓存，精确匹配请求内容，支持 TTL 过期和 LRU 淘汰
+"""
+import asyncio
+import hashlib
+import logging
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+def _orjson_default(obj: Any) -> Any:
+    """orjson 无法直接序列化的对象（Pydantic 模型等）"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json", exclude_none=True)
+    raise TypeError(f"无法序列化的类型: {type(obj).__name__}")
+
+
+def _canonical_image(image: Dict[str, Any]) -> Dict[str, Any]:
+    """规范化图片条目：去掉空字段，mime_type 缺省与转换逻辑一致"""
+    canonical = {key: value for key, value in image.items() if value is not None}
+    canonical.setdefault("mime_type", "image/jpeg")
+    return canonical
+
+
+def _canonical_message(msg: Any) -> Dict[str, Any]:
+    """规范化单条消息，使语义相同的请求得到相同的缓存键
+
+    去掉值为空的字段和空的 images/files，角色统一为小写，文本做 NFC 归一化并去掉首尾空白。
+    """
+    if hasattr(msg, "model_dump"):
+        msg = msg.model_dump(mode="json", exclude_none=True)
+    elif not isinstance(msg, dict):
+        return msg
+
+    canonical = {}
+    for key, value in msg.items():
+        if value is None:
+            continue
+        if key == "role" and isinstance(value, str):
+            value = value.lower()
+        elif key == "content" and isinstance(value, str):
+            value = unicodedata.normalize("NFC", value.strip())
+        elif key in ("images", "files"):
+            if not value:
+                continue
+            if key == "images":
+                value = [_canonical_image(image) if isinstance(image, dict) else image for image in value]
+        canonical[key] = value
+    return canonical
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 512, ttl: int = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (写入时间, 序列化后的响应)
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        # 命中 / 未命中次数（过期条目计为未命中）
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, provider: str, model: str, messages: List[Any], **params: Any) -> str:
+        """根据提供商、模型、消息和其余请求参数计算缓存键"""
+        payload = {
+            "provider": provider,
+            "model": model,
+            "messages": [_canonical_message(msg) for msg in messages],
+            "params": params
+        }
+        raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=_orjson_default)
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """读取缓存，未命中或已过期时返回 None；每次返回新的副本，调用方可以自由修改"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        stored_at, data = entry
+        if time.time() - stored_at >= self.ttl:
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return orjson.loads(data)
+
+    def put(self, key: str, value: Any):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        try:
+            data = orjson.dumps(value, default=_orjson_default)
+        except TypeError as e:
+            logger.warning(f"响应无法序列化，跳过缓存: {e}")
+            return
+
+        self._entries[key] = (time.time(), data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def stream_with_cache(
+        self,
+        key: str,
+        produce: Callable[[], AsyncGenerator[Dict[str, Any], None]],
+        refresh: bool = False
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """带缓存的流式输出：命中时回放缓存的数据块，未命中时边转发边记录，完整结束后写入缓存
+
+        refresh 为 True 时不读取缓存，重新生成的结果覆盖原有条目。
+        """
+        cached_chunks = None if refresh else self.get(key)
+        if cached_chunks is not None:
+            logger.info("命中流式响应缓存，回放 %s 个数据块", len(cached_chunks))
+            for chunk in cached_chunks:
+                yield chunk
+                # 让出事件循环，避免长回放独占调度
+                await asyncio.sleep(0)
+            return
+
+        chunks: List[Dict[str, Any]] = []
+        async for chunk in produce():
+            chunks.append(chunk)
+            yield chunk
+
+        # 出错的流不缓存
+        if chunks and not any(isinstance(chunk, dict) and "error" in chunk for chunk in chunks):
+            self.put(key, chunks)
+
+    def stats(self) -> Dict[str, int]:
+        """缓存统计：命中次数、未命中次数和当前条目数"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
@@ -0,0 +1,399 @@
+"""
+Response Format
+Responses API 输出（含流式事件）和 Anthropic 内容块到 Chat Completions 格式的转换（纯函数，完整类型注解）
+"""
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import orjson
+
+
+def _handle_reasoning(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取推理内容"""
+    for summary_item in item.get("summary", []):
+        if summary_item.get("type") == "summary_text":
+            state["reasoning_content"] = summary_item.get("text", "")
+            break
+
+
+def _handle_image_generation(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取图片生成结果"""
+    state.setdefault("image_generations", []).append({
+        "id": item.get("id"),
+        "type": "image_generation_call",
+        "status": item.get("status"),
+        "result": item.get("result"),
+        "revised_prompt": item.get("revised_prompt")
+    })
+
+
+def _handle_function_call(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取function calling结果（根据官方文档格式）"""
+    state.setdefault("function_calls", []).append({
+        "id": item.get("call_id", item.get("id")),  # 使用call_id作为主ID
+        "type": "function",
+        "function": {
+            "name": item.get("name"),
+            "arguments": item.get("arguments", "{}")
+        }
+    })
+    state["finish_reason"] = "tool_calls"
+
+
+def _handle_custom_tool_call(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取custom tool calling结果"""
+    state.setdefault("custom_tool_calls", []).append({
+        "id": item.get("id"),
+        "type": "custom_tool_call",
+        "name": item.get("name"),
+        "input": item.get("input", ""),
+        "call_id": item.get("call_id")
+    })
+    state["finish_reason"] = "tool_calls"
+
+
+def _handle_mcp_list_tools(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取MCP工具列表（根据官方文档）"""
+    state.setdefault("mcp_list_tools", []).append({
+        "id": item.get("id"),
+        "type": "mcp_list_tools",
+        "server_label": item.get("server_label"),
+        "tools": item.get("tools", [])
+    })
+
+
+def _handle_mcp_call(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取MCP调用结果，并根据调用状态设置finish_reason"""
+    error = item.get("error")
+    approval_request_id = item.get("approval_request_id")
+    state.setdefault("mcp_calls", []).append({
+        "id": item.get("id"),
+        "type": "mcp_call",
+        "server_label": item.get("server_label"),
+        "name": item.get("name"),
+        "arguments": item.get("arguments"),
+        "output": item.get("output"),
+        "error": error,
+        "approval_request_id": approval_request_id,
+        "status": item.get("status", "completed"),
+        "execution_time": item.get("execution_time")
+    })
+
+    if error:
+        state["finish_reason"] = "mcp_error"
+    elif approval_request_id:
+        state["finish_reason"] = "approval_required"
+    else:
+        state["finish_reason"] = "mcp_tool_calls"
+
+
+def _handle_mcp_approval_request(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取MCP审批请求"""
+    state.setdefault("mcp_approval_requests", []).append({
+        "id": item.get("id"),
+        "type": "mcp_approval_request",
+        "server_label": item.get("server_label"),
+        "name": item.get("name"),
+        "arguments": item.get("arguments")
+    })
+    state["finish_reason"] = "approval_required"
+
+
+def _handle_message(item: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """提取助手消息的文本内容"""
+    if item.get("role") != "assistant":
+        return
+    for content_item in item.get("content", []):
+        if content_item.get("type") == "output_text":
+            state["assistant_content"] = content_item.get("text", "")
+            break
+
+
+# Responses API 输出条目类型 -> 处理函数
+_OUTPUT_HANDLERS: Dict[str, Callable[[Dict[str, Any], Dict[str, Any]], None]] = {
+    "reasoning": _handle_reasoning,
+    "image_generation_call": _handle_image_generation,
+    "function_call": _handle_function_call,
+    "custom_tool_call": _handle_custom_tool_call,
+    "mcp_list_tools": _handle_mcp_list_tools,
+    "mcp_call": _handle_mcp_call,
+    "mcp_approval_request": _handle_mcp_approval_request,
+    "message": _handle_message
+}
+
+
+def convert_responses_to_chat_format(responses_result: Dict[str, Any]) -> Dict[str, Any]:
+    """将 Responses API 格式转换为标准 Chat Completions 格式"""
+    if "choices" in responses_result:
+        # 已经是标准格式，直接返回
+        return responses_result
+
+    if "output" not in responses_result:
+        # 不是 Responses API 格式，直接返回
+        return responses_result
+
+    # 转换 Responses API 格式（按输出类型查表分发，每个条目只做一次类型查找）
+    # 列表类结果由处理函数按需创建，未出现的输出类型不分配空列表
+    output = responses_result.get("output", [])
+    state: Dict[str, Any] = {
+        "reasoning_content": "",
+        "assistant_content": "",
+        "finish_reason": "stop"
+    }
+
+    handlers = _OUTPUT_HANDLERS
+    for item in output:
+        handler = handlers.get(item.get("type"))
+        if handler is not None:
+            handler(item, state)
+
+    # 构造消息对象
+    message: Dict[str, Any] = {
+        "role": "assistant",
+        "content": state["assistant_content"]
+    }
+
+    # 添加tool_calls如果有function calling
+    if "function_calls" in state:
+        message["tool_calls"] = state["function_calls"]
+
+    # 添加custom tool calls如果有
+    if "custom_tool_calls" in state:
+        message["custom_tool_calls"] = state["custom_tool_calls"]
+
+    # 如果有推理内容，添加到消息中
+    if state["reasoning_content"]:
+        message["reasoning"] = state["reasoning_content"]
+
+    # 如果有图片生成结果、MCP工具列表、MCP调用结果或MCP审批请求，添加到消息中
+    for key in ("image_generations", "mcp_list_tools", "mcp_calls", "mcp_approval_requests"):
+        if key in state:
+            message[key] = state[key]
+
+    # 构造标准格式响应（默认值只在缺失时构造）
+    response_id = responses_result.get("id")
+    if response_id is None:
+        response_id = f"resp_{hash(str(output)) % 1000000}"
+    usage = responses_result.get("usage")
+    if usage is None:
+        usage = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0
+        }
+
+    return {
+        "id": response_id,
+        "choices": [{
+            "message": message,
+            "finish_reason": state["finish_reason"],
+            "index": 0
+        }],
+        "usage": usage
+    }
+
+
+# 引用字段及缺省值（顺序与 _CITATION_FIELDS 一致）
+_CITATION_DEFAULTS = (
+    ("type", "unknown"),
+    ("cited_text", ""),
+    ("source", ""),
+    ("title", ""),
+    ("document_index", 0),
+    ("start_char_index", 0),
+    ("end_char_index", 0)
+)
+_CITATION_KEYS = tuple(key for key, _ in _CITATION_DEFAULTS)
+_CITATION_FIELDS = attrgetter(*_CITATION_KEYS)
+
+
+def _citation_to_dict(citation: Any) -> Dict[str, Any]:
+    """提取单条引用；字段齐全时一次取出全部属性，不同引用类型缺少部分字段时逐个取并使用缺省值"""
+    try:
+        return dict(zip(_CITATION_KEYS, _CITATION_FIELDS(citation)))
+    except AttributeError:
+        return {key: getattr(citation, key, default) for key, default in _CITATION_DEFAULTS}
+
+
+def _handle_anthropic_text(block: Any, state: Dict[str, Any]) -> None:
+    """提取文本内容和引用"""
+    state.setdefault("content", []).append(getattr(block, "text", ""))
+
+    citations = getattr(block, "citations", None)
+    if citations:
+        state.setdefault("citations", []).extend(map(_citation_to_dict, citations))
+
+
+def _handle_anthropic_thinking(block: Any, state: Dict[str, Any]) -> None:
+    """提取扩展思考内容"""
+    state["reasoning"] = getattr(block, "content", "") or getattr(block, "thinking", "")
+
+
+def _handle_anthropic_tool_use(block: Any, state: Dict[str, Any]) -> None:
+    """提取标准function calling工具使用"""
+    state.setdefault("tool_calls", []).append({
+        "id": getattr(block, "id", ""),
+        "type": "function",
+        "function": {
+            "name": getattr(block, "name", ""),
+            "arguments": orjson.dumps(getattr(block, "input", {})).decode()
+        }
+    })
+
+
+def _handle_anthropic_mcp_tool_use(block: Any, state: Dict[str, Any]) -> None:
+    """提取MCP工具使用"""
+    state.setdefault("mcp_tool_uses", []).append({
+        "id": getattr(block, "id", ""),
+        "type": "mcp_tool_use",
+        "name": getattr(block, "name", ""),
+        "server_name": getattr(block, "server_name", ""),
+        "input": getattr(block, "input", {})
+    })
+
+
+def _handle_anthropic_mcp_tool_result(block: Any, state: Dict[str, Any]) -> None:
+    """提取MCP工具结果"""
+    state.setdefault("mcp_tool_results", []).append({
+        "tool_use_id": getattr(block, "tool_use_id", ""),
+        "type": "mcp_tool_result",
+        "is_error": getattr(block, "is_error", False),
+        "content": getattr(block, "content", []),
+        "server_name": getattr(block, "server_name", ""),
+        "execution_time": getattr(block, "execution_time", None)
+    })
+
+
+# Anthropic 内容块类型 -> 处理函数（未开启思考模式时忽略 thinking 块）
+_ANTHROPIC_BLOCK_HANDLERS: Dict[str, Callable[[Any, Dict[str, Any]], None]] = {
+    "text": _handle_anthropic_text,
+    "tool_use": _handle_anthropic_tool_use,
+    "mcp_tool_use": _handle_anthropic_mcp_tool_use,
+    "mcp_tool_result": _handle_anthropic_mcp_tool_result
+}
+_ANTHROPIC_THINKING_BLOCK_HANDLERS: Dict[str, Callable[[Any, Dict[str, Any]], None]] = {
+    **_ANTHROPIC_BLOCK_HANDLERS,
+    "thinking": _handle_anthropic_thinking
+}
+
+
+def anthropic_blocks_to_message(content_blocks: Iterable[Any], thinking_mode: bool = False) -> Dict[str, Any]:
+    """将 Anthropic 响应内容块转换为 Chat Completions 格式的助手消息
+
+    citations / tool_calls / mcp_tool_uses / mcp_tool_results 按需创建，没有对应内容块时不出现在消息中。
+    """
+    state: Dict[str, Any] = {}
+    handlers = _ANTHROPIC_THINKING_BLOCK_HANDLERS if thinking_mode else _ANTHROPIC_BLOCK_HANDLERS
+    for block in content_blocks:
+        handler = handlers.get(getattr(block, "type", None))
+        if handler is not None:
+            handler(block, state)
+
+    # 一次构造消息：推理内容非空时加入，其余的列表类结果按出现顺序加入
+    content = "".join(state.pop("content", ()))
+    reasoning = state.pop("reasoning", "")
+    return {
+        "role": "assistant",
+        "content": content,
+        **({"reasoning": reasoning} if reasoning else {}),
+        **state
+    }
+
+
+def _stream_chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+    """构造 Chat Completions 格式的流式增量块"""
+    return {
+        "choices": [{
+            "delta": delta,
+            "index": 0,
+            "finish_reason": finish_reason
+        }]
+    }
+
+
+def _image_generation_result(data: Any) -> Dict[str, Any]:
+    """提取图片生成结果"""
+    return {
+        "id": getattr(data, "id", None),
+        "type": "image_generation_call",
+        "status": getattr(data, "status", None) or "completed",
+        "result": getattr(data, "result", None),
+        "revised_prompt": getattr(data, "revised_prompt", None)
+    }
+
+
+# 流式事件处理函数直接读取事件对象上需要的字段，不把每个事件整体序列化为字典
+def _on_reasoning_summary_part_done(event: Any) -> Optional[Dict[str, Any]]:
+    """reasoning summary 作为 reasoning 增量发送"""
+    summary_text = getattr(getattr(event, "part", None), "text", "")
+    if not summary_text:
+        return None
+    return _stream_chunk({"reasoning": summary_text})
+
+
+def _on_output_text_delta(event: Any) -> Dict[str, Any]:
+    """文本增量"""
+    return _stream_chunk({"content": getattr(event, "delta", "")})
+
+
+def _on_image_generation_call_done(event: Any) -> Dict[str, Any]:
+    """图片生成调用完成"""
+    return _stream_chunk({"image_generation": _image_generation_result(getattr(event, "image_generation_call", None))})
+
+
+def _on_output_item_done(event: Any) -> Optional[Dict[str, Any]]:
+    """输出条目完成，只有图片生成结果需要发送"""
+    item = getattr(event, "item", None)
+    if getattr(item, "type", None) != "image_generation_call":
+        return None
+    return _stream_chunk({"image_generation": _image_generation_result(item)})
+
+
+def _on_completed(event: Any) -> Dict[str, Any]:
+    """响应完成"""
+    return _stream_chunk({}, "stop")
+
+
+def _on_failed(event: Any) -> Dict[str, Any]:
+    """响应失败"""
+    error = getattr(getattr(event, "response", None), "error", None)
+    return {"error": getattr(error, "message", None) or "Unknown error"}
+
+
+# Responses API 流式事件类型 -> 处理函数（返回要发送的数据块，None 表示不发送）
+RESPONSES_STREAM_EVENT_HANDLERS: Dict[str, Callable[[Any], Optional[Dict[str, Any]]]] = {
+    "response.output_text.delta": _on_output_text_delta,
+    "response.reasoning_summary_part.done": _on_reasoning_summary_part_done,
+    "response.image_generation_call.done": _on_image_generation_call_done,
+    "response.output_item.done": _on_output_item_done,
+    "response.completed": _on_completed,
+    "response.failed": _on_failed
+}
+
+# 不需要发送给前端、但表示流仍在进行的事件
+RESPONSES_IGNORED_STREAM_EVENTS = frozenset({
+    "response.created",
+    "response.in_progress",
+    "response.output_item.added",
+    "response.content_part.added",
+    "response.content_part.done",
+    "response.output_text.done",
+    "response.reasoning_summary_part.added",
+    "response.reasoning_summary_text.delta",
+    "response.reasoning_summary_text.done",
+    "response.web_search_call.in_progress",
+    "response.web_search_call.searching",
+    "response.web_search_call.completed",
+    "response.file_search_call.in_progress",
+    "response.file_search_call.searching",
+    "response.file_search_call.completed",
+    "response.image_generation_call.in_progress",
+    "response.image_generation_call.generating",
+    "response.image_generation_call.partial_image",
+    "response.mcp_list_tools.in_progress",
+    "response.mcp_list_tools.completed",
+    "response.mcp_call.in_progress",
+    "response.mcp_call_arguments.delta",
+    "response.mcp_call_arguments.done",
+    "response.mcp_call.completed"
+})
@@ -5,7 +5,7 @@ import time
 import logging
 import asyncio
 from app.api.v1 import chat, sync, voice, image, file, deep_research
-from app.services.ai_providers import AIProviderService
+from app.services.ai_providers import AIProviderService, get_ai_service
 
 # 配置日志
 logging.basicConfig(
@@ -25,12 +25,17 @@ app = FastAPI(
 async def startup_event():
     logger.info("应用启动中,预加载模型配置...")
     try:
-        ai_service = AIProviderService()
+        ai_service = get_ai_service()
         await ai_service._load_models_config()
         logger.info("模型配置预加载成功")
     except Exception as e:
         logger.warning(f"模型配置预加载失败(将在首次请求时重试): {e}")
 
+# 关闭时释放共享的 HTTP 连接池
+@app.on_event("shutdown")
+async def shutdown_event():
+    await AIProviderService.close_http_clients()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -71,7 +76,12 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    health = {"status": "healthy"}
+    # 开启响应缓存时附带命中统计
+    cache = AIProviderService._get_response_cache()
+    if cache is not None:
+        health["response_cache"] = cache.stats()
+    return health
 
 @app.get("/docs")
 async def docs_redirect():
@@ -26,9 +26,9 @@ interface ChatState {
   // Actions
   createNewConversation: () => void
   setCurrentConversation: (id: string) => void
-  sendMessage: (content: string, images?: ImageAttachment[], files?: FileAttachment[], tools?: any[]) => Promise<void>
-  _sendMessageWithStreaming: (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[]) => Promise<void>
-  _sendMessageNormal: (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[]) => Promise<void>
+  sendMessage: (content: string, images?: ImageAttachment[], files?: FileAttachment[], tools?: any[], regenerate?: boolean) => Promise<void>
+  _sendMessageWithStreaming: (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[], regenerate?: boolean) => Promise<void>
+  _sendMessageNormal: (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[], regenerate?: boolean) => Promise<void>
   stopGeneration: () => void
   deleteConversation: (id: string) => void
   updateConversationTitle: (id: string, title: string) => void
@@ -270,7 +270,7 @@ export const useChatStore = create<ChatState>()(
         set({ conversations: [], currentConversationId: null })
       },
 
-      sendMessage: async (content: string, images?: ImageAttachment[], files?: FileAttachment[], tools?: any[]) => {
+      sendMessage: async (content: string, images?: ImageAttachment[], files?: FileAttachment[], tools?: any[], regenerate?: boolean) => {
         // 动态导入 settingsStore 和 modelConfigService 以避免循环依赖
         const { useSettingsStore } = await import('./settingsStore')
         const { modelConfigService } = await import('../services/modelConfigService')
@@ -352,14 +352,14 @@ export const useChatStore = create<ChatState>()(
         
         if (supportsStreaming) {
           // 使用流式输出（包括thinking模式）
-          await get()._sendMessageWithStreaming(content, targetConversationId, settings, apiKey, assistantMessage.id, tools)
+          await get()._sendMessageWithStreaming(content, targetConversationId, settings, apiKey, assistantMessage.id, tools, regenerate)
         } else {
           // 使用普通输出（不支持流式的模型）
-          await get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessage.id, tools)
+          await get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessage.id, tools, regenerate)
         }
       },
 
-      _sendMessageWithStreaming: async (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[]) => {
+      _sendMessageWithStreaming: async (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[], regenerate?: boolean) => {
         const abortController = new AbortController()
         set({ abortController })
 
@@ -525,6 +525,11 @@ export const useChatStore = create<ChatState>()(
                 request.base_url = settings.openaiCompatibleConfig.baseUrl
               }
 
+              // 重新生成时要求后端跳过响应缓存
+              if (regenerate) {
+                request.regenerate = true
+              }
+
               // 处理所有工具(搜索、MCP服务器、函数调用)
               if (tools && tools.length > 0) {
                 const requestTools: any[] = []
@@ -673,7 +678,7 @@ export const useChatStore = create<ChatState>()(
                 } else {
                   // Fallback to HTTP after max attempts
                   console.log('WebSocket重连失败，切换到HTTP模式')
-                  get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools)
+                  get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools, regenerate)
                 }
               }
 
@@ -686,7 +691,7 @@ export const useChatStore = create<ChatState>()(
                   }, get().wsReconnectDelay * Math.pow(2, attempt))
                 } else if (!event.wasClean && attempt >= get().wsMaxReconnectAttempts) {
                   console.log('WebSocket连接断开且重试失败，切换到HTTP模式')
-                  get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools)
+                  get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools, regenerate)
                 } else {
                   if (Object.keys(imageGenerationMap).length > 0) {
                     updateAssistantImages(Object.values(imageGenerationMap))
@@ -714,7 +719,7 @@ export const useChatStore = create<ChatState>()(
                 }, get().wsReconnectDelay * Math.pow(2, attempt))
               } else {
                 console.log('WebSocket连接彻底失败，切换到HTTP模式')
-                get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools)
+                get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools, regenerate)
               }
             }
           }
@@ -754,7 +759,7 @@ export const useChatStore = create<ChatState>()(
           // Final fallback to HTTP
           try {
             console.log('尝试HTTP fallback')
-            await get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools)
+            await get()._sendMessageNormal(content, targetConversationId, settings, apiKey, assistantMessageId, tools, regenerate)
           } catch (httpError: any) {
             console.error('HTTP fallback也失败了:', httpError)
             throw httpError
@@ -762,7 +767,7 @@ export const useChatStore = create<ChatState>()(
         }
       },
 
-      _sendMessageNormal: async (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[]) => {
+      _sendMessageNormal: async (content: string, targetConversationId: string, settings: any, apiKey: string, assistantMessageId: string, tools?: any[], regenerate?: boolean) => {
         const abortController = new AbortController()
         set({ abortController })
 
@@ -816,6 +821,11 @@ export const useChatStore = create<ChatState>()(
             requestBody.base_url = settings.openaiCompatibleConfig.baseUrl
           }
 
+          // 重新生成时要求后端跳过响应缓存
+          if (regenerate) {
+            requestBody.regenerate = true
+          }
+
           // 处理所有工具(搜索、MCP服务器、函数调用)
           if (tools && tools.length > 0) {
             const requestTools: any[] = []
@@ -1078,7 +1088,7 @@ export const useChatStore = create<ChatState>()(
           .find(msg => msg.role === 'user')
 
         if (lastUserMessage) {
-          await get().sendMessage(lastUserMessage.content)
+          await get().sendMessage(lastUserMessage.content, undefined, undefined, undefined, true)
         }
       },
 